@@ -0,0 +1,266 @@
+# /usr/bin/python3
+# Microbenchmarks for the codec: Marshalling, Qid, Stat and whole T/R frames
+# through Protocol.next(). Runs on cpython and micropython.
+#
+#   python3 ninepbench.py                      run everything
+#   python3 ninepbench.py stat                 only cases with 'stat' in the name
+#   python3 ninepbench.py --save base.json     keep the results as a baseline
+#   python3 ninepbench.py --compare base.json  flag regressions against it
+#   python3 ninepbench.py --threshold 0.2      slowdown that counts (default 0.15)
+#
+# ns/op is the best of several rounds. B/op is the memory allocated per op:
+# exact on micropython (gc.mem_alloc with the collector off), the transient
+# peak seen by tracemalloc on cpython. Exits with 1 if anything regressed.
+import sys
+import gc
+import json
+import random
+import time
+
+from peanein.base import Marshalling, Qid, Stat
+from peanein.server import Server
+
+from noddy import Noddy
+
+ROUNDS = 5
+TARGET_NS = 20000000  # aim for about 20ms per round
+
+
+def now_ns():
+    if hasattr(time, "perf_counter_ns"):
+        return time.perf_counter_ns()
+    return time.ticks_us() * 1000
+
+
+def elapsed_ns(start, end):
+    if hasattr(time, "ticks_diff"):
+        return time.ticks_diff(end // 1000, start // 1000) * 1000
+    return end - start
+
+
+class Feed:
+    # channel that hands out the same frame over and over
+    def __init__(self, frame=b""):
+        self.frame = frame
+        self.ptr = 0
+
+    def read(self, n=-1):
+        data = self.frame[self.ptr:self.ptr + n]
+        self.ptr = (self.ptr + n) % len(self.frame)
+        return data
+
+    def readinto(self, buf):
+        n = len(buf)
+        buf[:] = self.frame[self.ptr:self.ptr + n]
+        self.ptr = (self.ptr + n) % len(self.frame)
+        return n
+
+
+def frame(verb, tag, payload):
+    m = Marshalling()
+    return bytes(m.serialize_uint(len(payload) + 7, 4) + m.serialize_uint(verb, 1) +
+                 m.serialize_uint(tag, 2) + payload)
+
+
+def names(count, seed=9):
+    # file name lengths skewed short, the way real trees are
+    random.seed(seed)
+    out = []
+    for i in range(count):
+        size = 3 + random.getrandbits(3) + random.getrandbits(3) * random.getrandbits(2)
+        out.append("".join(chr(97 + random.getrandbits(4)) for _ in range(size)))
+    return out
+
+
+def stats(count):
+    out = []
+    for i, name in enumerate(names(count)):
+        if i % 5 == 0:
+            qid = Qid(Qid.QTDIR, i, 1000 + i)
+        else:
+            qid = Qid(Qid.QTFILE, i, 1000 + i)
+        out.append(Stat(name, qid, length=i * 977, mtime=1600000000 + i, atime=1600000000 + i))
+    return out
+
+
+def cases():
+    m = Marshalling()
+    out = []
+
+    # primitives
+    for size in (1, 2, 4, 8):
+        data = bytearray(range(16))
+        view = memoryview(data)
+        out.append(("parse_uint %d" % size, lambda s=size, v=view: m.parse_uint(v, 3, s)))
+    pas = [m.str_to_pas(name) for name in names(64)]
+    out.append(("parse_string names", lambda: [m.parse_string(p, 0) for p in pas], len(pas)))
+
+    sample = stats(64)
+    encoded = [s.serialize() for s in sample]
+    out.append(("parse_stat", lambda: [m.parse_stat(e, 0) for e in encoded], len(encoded)))
+    qids = [s.qid for s in sample]
+    out.append(("Qid.serialize", lambda: [q.serialize() for q in qids], len(qids)))
+    tx = bytearray(8192)
+    out.append(("Qid.serialize_into", lambda: [q.serialize_into(tx, 7) for q in qids], len(qids)))
+    out.append(("Stat.serialize", lambda: [s.serialize() for s in sample], len(sample)))
+    out.append(("Stat.serialize_into", lambda: [s.serialize_into(tx, 7) for s in sample], len(sample)))
+
+    # whole frames: parse the T message, run the handler, encode the R message
+    for static in (False, True):
+        mode = " static" if static else ""
+        for label, setup, requests in frame_cases():
+            srv = Server(Feed(b"".join(requests)), Noddy(), static_buffers=static)
+            srv.write = lambda data: len(data)  # replies are encoded, not sent
+            for verb, payload in setup:
+                srv.dispatch(verb, 1, payload)
+            if len(requests) == 1:
+                out.append(("frame " + label + mode, srv.next))
+            else:
+                out.append(("frame " + label + mode, lambda s=srv, n=len(requests): [s.next() for _ in range(n)]))
+    return out
+
+
+def frame_cases():
+    m = Marshalling()
+    nofid = 0xffffffff
+    version = m.serialize_uint(8192, 4) + m.str_to_pas("9P2000")
+    attach = m.serialize_uint(1, 4) + m.serialize_uint(nofid, 4) + m.str_to_pas("bench") + m.str_to_pas("")
+
+    def walk(fid, newfid, path):
+        data = m.serialize_uint(fid, 4) + m.serialize_uint(newfid, 4) + m.serialize_uint(len(path), 2)
+        for name in path:
+            data += m.str_to_pas(name)
+        return data
+
+    def fid_mode(fid, mode):
+        return m.serialize_uint(fid, 4) + m.serialize_uint(mode, 1)
+
+    def read(fid, offset, count):
+        return m.serialize_uint(fid, 4) + m.serialize_uint(offset, 8) + m.serialize_uint(count, 4)
+
+    base = [(Server.Tversion, version), (Server.Tattach, attach),
+            (Server.Twalk, walk(1, 2, ["dev", "zero"])), (Server.Topen, fid_mode(2, 0)),
+            (Server.Twalk, walk(1, 3, ["dev", "null"])), (Server.Topen, fid_mode(3, 1))]
+    # each case is the frames of one round trip, newfids are clunked again
+    clunk = frame(Server.Tclunk, 8, m.serialize_uint(9, 4))
+    out = []
+    for count in (0, 64, 512, 4096):
+        out.append(("Tread %d" % count, base, [frame(Server.Tread, 7, read(2, 0, count))]))
+    for count in (16, 512, 4096):
+        payload = read(3, 0, count) + bytes(count)
+        out.append(("Twrite %d" % count, base, [frame(Server.Twrite, 7, payload)]))
+    out.append(("Twalk 1+Tclunk", base, [frame(Server.Twalk, 7, walk(1, 9, ["dev"])), clunk]))
+    out.append(("Twalk 3+Tclunk", base, [frame(Server.Twalk, 7, walk(1, 9, ["dev", "ttys", "tty1"])), clunk]))
+    out.append(("Tstat", base, [frame(Server.Tstat, 7, m.serialize_uint(2, 4))]))
+    out.append(("Tclunk", base, [frame(Server.Tclunk, 7, m.serialize_uint(99, 4))]))
+    return out
+
+
+def measure(fn, per_call=1):
+    # how many calls make a round long enough to time
+    n = 1
+    while True:
+        start = now_ns()
+        for _ in range(n):
+            fn()
+        spent = elapsed_ns(start, now_ns())
+        if spent > TARGET_NS // 10 or n >= 1 << 20:
+            break
+        n *= 2
+    n = max(1, n * (TARGET_NS // max(spent, 1)) // 1)
+    best = None
+    for _ in range(ROUNDS):
+        start = now_ns()
+        for _ in range(n):
+            fn()
+        spent = elapsed_ns(start, now_ns())
+        if best is None or spent < best:
+            best = spent
+    return best / (n * per_call), allocated(fn, per_call)
+
+
+def allocated(fn, per_call):
+    fn()  # warm up caches
+    if hasattr(gc, "mem_alloc"):
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        for _ in range(16):
+            fn()
+        used = gc.mem_alloc() - before
+        gc.enable()
+        return used / (16 * per_call)
+    # cpython frees as it goes, so take the smallest peak over a few calls
+    import tracemalloc
+    tracemalloc.start()
+    least = None
+    for _ in range(ROUNDS):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] - base
+        if least is None or peak < least:
+            least = peak
+    tracemalloc.stop()
+    return least / per_call
+
+
+def main(argv):
+    save = None
+    compare = None
+    threshold = 0.15
+    pattern = None
+    i = 0
+    while i < len(argv):
+        if argv[i] == "--save":
+            i += 1
+            save = argv[i]
+        elif argv[i] == "--compare":
+            i += 1
+            compare = argv[i]
+        elif argv[i] == "--threshold":
+            i += 1
+            threshold = float(argv[i])
+        else:
+            pattern = argv[i]
+        i += 1
+
+    baseline = {}
+    if compare is not None:
+        with open(compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressed = 0
+    print("%-28s %12s %10s  %s" % ("case", "ns/op", "B/op", "vs baseline"))
+    for case in cases():
+        name, fn = case[0], case[1]
+        per_call = case[2] if len(case) > 2 else 1
+        if pattern is not None and pattern not in name:
+            continue
+        ns, allocs = measure(fn, per_call)
+        results[name] = {"ns": ns, "bytes": allocs}
+        note = ""
+        if name in baseline:
+            old = baseline[name]
+            change = (ns - old["ns"]) / old["ns"]
+            note = "%+.1f%%" % (change * 100)
+            if change > threshold:
+                note += " SLOWER"
+                regressed += 1
+            if allocs > old["bytes"] * (1 + threshold) + 8:
+                note += " MORE ALLOCATION (was %.0f)" % old["bytes"]
+                regressed += 1
+        print("%-28s %12.1f %10.0f  %s" % (name, ns, allocs, note))
+
+    if save is not None:
+        with open(save, "w") as f:
+            json.dump(results, f)
+    if regressed:
+        print("%d regression(s)" % regressed)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,33 +1,57 @@
-from peanein.server import Server
-from peanein.base import FileSystemDriver, Stat, Qid
-import socket
+from peanein.asyncserver import AsyncServer
+from peanein.asyncdriver import ExecutorDriver
+from peanein.base import TreeRegistry
+from peanein.packed import PackedImageDriver
+from peanein.ramfs import RamFS
+from peanein.profiling import profiler
+import asyncio
+import signal
+import sys
 from noddy import Noddy
 
+# one namespace for every client, built once at startup
+driver = ExecutorDriver(Noddy())
+# extra trees, also shared: aname=image.pea on the command line
+trees = TreeRegistry()
+# scratch space, attach with aname "tmp"
+trees.register("tmp", ExecutorDriver(RamFS(capacity=16 * 1024 * 1024)))
+
+
+async def client_connected(reader, writer):
+    print('client connected from', writer.get_extra_info('peername'))
+    srv = AsyncServer(reader, writer, driver, trees=trees)
+    try:
+        await srv.serve()
+    except EOFError as x:
+        print("EOF:", x)
+    except IOError as e:
+        print("listening again...", e)
+    finally:
+        print('client gone', srv.stats())
+        writer.close()
+
+
+def toggle_profiler():
+    # kill -USR1 starts a 60 second profile, a second one stops it early
+    if profiler.running:
+        print('profiler:', profiler.stop())
+    else:
+        profiler.start(seconds=60)
+        print('profiler:', profiler.status().strip())
+
+
+async def main():
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, toggle_profiler)
+    server = await asyncio.start_server(client_connected, '0.0.0.0', 9999)
+    print('listening on', server.sockets[0].getsockname())
+    async with server:
+        await server.serve_forever()
 
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
-    addr = socket.getaddrinfo('0.0.0.0', 9999)[0][-1]
-    s = socket.socket()
-    s.bind(addr)
-    s.listen(1)
-
-    print('listening on', addr)
-
-    while True:
-        cl, addr = s.accept()
-        print('client connected from', addr)
-        fd = cl.makefile('rwb', 0)
-        print("client fd =", fd)
-        srv = Server(fd, Noddy())
-        while True:
-            try:
-                srv.next()
-            except EOFError as x:
-                print("EOF:", x)
-                break
-            except IOError as e:
-                print("listening again...", e)
-                break
-        cl.close()
-    pass
+    for arg in sys.argv[1:]:
+        aname, image = arg.split('=', 1)
+        trees.register(aname, ExecutorDriver(PackedImageDriver(image)))
+        print('exporting', image, 'as', aname)
+    asyncio.run(main())
@@ -0,0 +1,173 @@
+# /usr/bin/python3
+# Round trips through the shared memory ring against loopback TCP and a
+# Unix socket. The server is a plain Server serving Noddy in a forked child,
+# the client a few lines of hand rolled 9P in the parent. cpython on Linux.
+#
+#   python3 ninepringbench.py             run everything
+#   python3 ninepringbench.py 2           seconds per case (default 1)
+#
+# rpc: Tstat, the smallest useful round trip. stream: Tread of 8000 bytes
+# from /dev/zero, reported as throughput too.
+#
+# On a single cpu expect the sockets to stay ahead: every round trip
+# switches process either way, and the ring's copies run in Python where a
+# socket's run in the kernel. The ring pays off once both ends have a core
+# of their own and it can spin instead of sleeping.
+import os
+import socket
+import sys
+import time
+
+from peanein.base import Marshalling
+from peanein.server import Server
+from peanein.shmring import ShmRingServer, ShmRingClient
+
+from noddy import Noddy
+
+RING = "/dev/shm/ninepringbench"
+READ_SIZE = 8000
+
+
+class SocketChannel:
+    def __init__(self, sock):
+        self.sock = sock
+
+    def read(self, n=-1):
+        data = bytearray(n)
+        view = memoryview(data)
+        got = 0
+        while got < n:
+            count = self.sock.recv_into(view[got:])
+            if count == 0:
+                return bytes(data[:got])
+            got += count
+        return data
+
+    def readinto(self, buf):
+        return self.sock.recv_into(buf)
+
+    def write(self, data):
+        self.sock.sendall(data)
+        return len(data)
+
+    def close(self):
+        self.sock.close()
+
+
+class Client(Marshalling):
+    def __init__(self, channel):
+        self.channel = channel
+
+    def rpc(self, verb, payload):
+        frame = self.serialize_uint(len(payload) + 7, 4) + self.serialize_uint(verb, 1) + \
+            self.serialize_uint(1, 2) + payload
+        self.channel.write(frame)
+        head = self.channel.read(7)
+        if len(head) < 7:
+            raise EOFError("server went away")
+        body = self.channel.read(self.parse_uint(head, 0, 4) - 7)
+        if head[4] == Server.Rerror:
+            raise IOError(self.parse_string(body, 0)[1])
+        return body
+
+    def setup(self):
+        m = self
+        self.channel.write(m.serialize_uint(19, 4) + m.serialize_uint(Server.Tversion, 1) +
+                           m.serialize_uint(Server.NOTAG, 2) + m.serialize_uint(8192, 4) + m.str_to_pas("9P2000"))
+        head = self.channel.read(7)
+        self.channel.read(self.parse_uint(head, 0, 4) - 7)
+        self.rpc(Server.Tattach, m.serialize_uint(1, 4) + m.serialize_uint(Server.NOFID, 4) +
+                 m.str_to_pas("bench") + m.str_to_pas(""))
+        self.rpc(Server.Twalk, m.serialize_uint(1, 4) + m.serialize_uint(2, 4) + m.serialize_uint(2, 2) +
+                 m.str_to_pas("dev") + m.str_to_pas("zero"))
+        self.rpc(Server.Topen, m.serialize_uint(2, 4) + m.serialize_uint(0, 1))
+
+    def stat(self):
+        self.rpc(Server.Tstat, self.serialize_uint(2, 4))
+
+    def read(self):
+        self.rpc(Server.Tread, self.serialize_uint(2, 4) + self.serialize_uint(0, 8) +
+                 self.serialize_uint(READ_SIZE, 4))
+
+
+def serve(channel):
+    srv = Server(channel, Noddy())
+    try:
+        while True:
+            srv.next()
+    except Exception:
+        pass
+    os._exit(0)
+
+
+def spawn(server_channel, client_channel):
+    # returns the pid of the server child
+    pid = os.fork()
+    if pid == 0:
+        client_channel.close()
+        serve(server_channel)
+    server_channel.close()
+    return pid
+
+
+def shm_pair():
+    server = ShmRingServer(RING, 65536)
+    pid = os.fork()
+    if pid == 0:
+        serve(server)
+    client = ShmRingClient(RING)
+    return pid, client, server
+
+
+def unix_pair():
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    pid = spawn(SocketChannel(b), SocketChannel(a))
+    return pid, SocketChannel(a), None
+
+
+def tcp_pair():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    accepted, _ = listener.accept()
+    listener.close()
+    for s in (client, accepted):
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    pid = spawn(SocketChannel(accepted), SocketChannel(client))
+    return pid, SocketChannel(client), None
+
+
+def measure(fn, seconds):
+    fn()
+    count = 0
+    start = time.perf_counter()
+    end = start + seconds
+    while True:
+        for _ in range(100):
+            fn()
+        count += 100
+        now = time.perf_counter()
+        if now >= end:
+            return (now - start) / count
+
+
+def main(argv):
+    seconds = float(argv[0]) if len(argv) > 0 else 1.0
+    print("%-8s %12s %12s %10s" % ("", "rpc us/op", "read us/op", "MB/s"))
+    for name, pair in (("shm", shm_pair), ("unix", unix_pair), ("tcp", tcp_pair)):
+        pid, channel, server = pair()
+        client = Client(channel)
+        client.setup()
+        rpc = measure(client.stat, seconds)
+        read = measure(client.read, seconds)
+        print("%-8s %12.1f %12.1f %10.1f" % (name, rpc * 1e6, read * 1e6, READ_SIZE / read / 1e6))
+        channel.close()
+        os.waitpid(pid, 0)
+        if server is not None:
+            server.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
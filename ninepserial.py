@@ -5,6 +5,7 @@ import time
 
 from peanein.server import Server
 from peanein.base import FileSystemDriver, Stat, Qid
+from peanein.codec import deflate_codec
 
 from noddy import Noddy
 
@@ -13,6 +14,9 @@ class StdioWrapper:
     def read(self, n=-1):
         return os.read(0, n)
 
+    def readinto(self, buf):
+        return os.readv(0, [buf])
+
     def write(self, s):
         return os.write(1, s)
 
@@ -25,6 +29,9 @@ class MicroPythonStdio:
     def read(self, n=-1):
         return sys.stdin.buffer.read(n)
 
+    def readinto(self, buf):
+        return sys.stdin.buffer.readinto(buf)
+
     def write(self, s):
         import machine
         return machine.stdout_put(s)
@@ -50,6 +57,10 @@ class MicroPythonStdioNeoPixel:
         self.next()
         return sys.stdin.buffer.read(n)
 
+    def readinto(self, buf):
+        self.next()
+        return sys.stdin.buffer.readinto(buf)
+
     def write(self, s):
         self.next()
         import machine
@@ -57,15 +68,19 @@ class MicroPythonStdioNeoPixel:
 
 
 def start():
+    static_buffers = False
     if sys.implementation.name == "micropython":
         import micropython
         # ignore break
         micropython.kbd_intr(-1)
         fd = MicroPythonStdioNeoPixel()
+        # don't fragment the heap with per-message buffers
+        static_buffers = True
     else:
         fd = StdioWrapper()
 
-    srv = Server(fd, Noddy())
+    # compression is only used if the client asks for 9P2000.z
+    srv = Server(fd, Noddy(), codec=deflate_codec(), static_buffers=static_buffers)
 
     while True:
         try:
@@ -2,17 +2,27 @@
 import sys,os
 import random
 
+try:
+    from _thread import allocate_lock
+except ImportError:
+    allocate_lock = None
+
 from peanein.server import Server
 from peanein.base import FileSystemDriver, Stat, Qid
+from peanein.profiling import profiler
 
 
 class Noddy(FileSystemDriver):
     fs = {}
     qids = {}
+    ttys = {}
+    TTY_BUFFER = 4096  # oldest output is dropped beyond this
 
     def __init__(self, io_size=4096):
         self.reset()
         self._io_size = io_size
+        # ttys may be used from several executor threads at once
+        self.lock = allocate_lock() if allocate_lock is not None else None
 
     def io_size(self) -> int:
         return self._io_size
@@ -26,22 +36,29 @@ class Noddy(FileSystemDriver):
         self.f("/dev/random", Stat("random", Qid(Qid.QTFILE, 0, 11)))
         self.f("/dev/zero", Stat("zero", Qid(Qid.QTFILE, 0, 12)))
         self.f("/dev/null", Stat("null", Qid(Qid.QTFILE, 0, 13)))
+        # profiler control: write "start seconds=10 mode=collapsed" or "stop",
+        # read for the status, see peanein/profiling.py
+        self.f("/dev/ctl", Stat("ctl", Qid(Qid.QTFILE, 0, 14), mode=0o600))
         self.f("/dev/ttys/tty1", Stat("tty1", Qid(Qid.QTFILE, 0, 21)))
         self.f("/dev/ttys/tty2", Stat("tty2", Qid(Qid.QTFILE, 0, 22)))
         self.f("/dev/ttys/tty3", Stat("tty3", Qid(Qid.QTFILE, 0, 23)))
         self.f("/dev/ttys/tty4", Stat("tty4", Qid(Qid.QTFILE, 0, 24)))
         self.f("/dev/ttys/tty5", Stat("tty5", Qid(Qid.QTFILE, 0, 25)))
+        # the ttys loop back: whatever is written can be read, once
+        self.ttys = {21: bytearray(), 22: bytearray(), 23: bytearray(),
+                     24: bytearray(), 25: bytearray()}
 
     def f(self, name, stat):
         self.fs[name] = stat
-        self.qids[stat.qid.to_str()] = name
+        # keyed by path alone, the version of a qid changes over time
+        self.qids[stat.qid.path] = name
 
     def get_root(self) -> Qid:
         stat = self.fs['/']
         return stat.qid
 
     def has_entry(self, qid, name) -> bool:
-        k = qid.to_str()
+        k = qid.path
         if k in self.qids:
             prefix = self.qids[k]
             if prefix == "/":
@@ -52,7 +69,7 @@ class Noddy(FileSystemDriver):
         return False
 
     def get_qid(self, qid, name) -> Qid:
-        k = qid.to_str()
+        k = qid.path
         if k in self.qids:
             prefix = self.qids[k]
             if prefix == "/":
@@ -62,8 +79,25 @@ class Noddy(FileSystemDriver):
                 return self.fs[path].qid
         return None  # Probably should throw an IOError
 
+    def walk_path(self, qid, names) -> list:
+        qids = []
+        k = qid.path
+        if k in self.qids:
+            path = self.qids[k]
+            for name in names:
+                if not qid.is_dir():
+                    break
+                if path == "/":
+                    path = ""
+                path = "%s/%s" % (path, name)
+                if path not in self.fs:
+                    break
+                qid = self.fs[path].qid
+                qids.append(qid)
+        return qids
+
     def get_stat(self, qid) -> Stat:
-        k = qid.to_str()
+        k = qid.path
         if k in self.qids:
             name = self.qids[k]
             if name in self.fs:
@@ -73,27 +107,23 @@ class Noddy(FileSystemDriver):
     def open_file(self, qid: Qid, mode: int):
         # first check permissions
 
-        k = qid.to_str()
-        if qid.is_dir():  # do directory listing
-            path = self.qids[k]
-            if path == '/':
-                slash_count = 1
-            else:
-                slash_count = path.count('/') + 1  # /foo/bar
-            entries = []
-            data = bytearray()
-            for name in self.fs.keys():
-                if name == "/":
+        # directory contents are produced lazily by list_dir
+        qid.private_data = 0
+
+    def list_dir(self, qid: Qid, index: int):
+        path = self.qids[qid.path]
+        if path == '/':
+            slash_count = 1
+        else:
+            slash_count = path.count('/') + 1  # /foo/bar
+        for name in self.fs.keys():
+            if name == "/":
+                continue
+            if name.startswith(path) and name.count('/') == slash_count:
+                if index > 0:
+                    index -= 1
                     continue
-                if name.startswith(path) and name.count('/') == slash_count:
-                    entries.append(name)
-            for name in entries:
-                stat = self.fs[name]
-                data += stat.serialize()
-            qid.private_data = data  # Stuff into private data
-
-        else:  # do file opening
-            qid.private_data = 0
+                yield self.fs[name]
 
     def close_file(self, qid: Qid):
         qid.private_data = None  # nothing more fancy required
@@ -107,17 +137,43 @@ class Noddy(FileSystemDriver):
             # doesnt work on early cpython3 data = bytearray(random.randbytes(count))
             return data
         elif qid.path == 12:  # zero
-            data = bytearray(b'\0' * count)
+            return bytearray(count)
+        elif qid.path == 14:  # ctl
+            return bytearray(profiler.status().encode()[offset:offset + count])
+        elif qid.path in self.ttys:
+            # ignore offset, it's a stream
+            buffer = self.ttys[qid.path]
+            self.acquire()
+            data = buffer[:count]
+            del buffer[:len(data)]
+            self.release()
             return data
-        elif qid.path == 13 or (qid.path > 20 and qid.path < 30):
+        else:  # null
             return bytearray()
-        else:  # it's a dir
-            length = len(qid.private_data)
-            if offset >= length:
-                return bytearray()
-            # it's only going to send a little data, so don't worry about 8K packet limit?
-            return qid.private_data[offset:]
 
     def write_file(self, qid: Qid, offset: int, data: bytes) -> int:
-        # ignore all writes
+        if qid.path == 14:  # ctl
+            profiler.command(str(bytes(data), "utf-8"))
+        elif qid.path in self.ttys:
+            buffer = self.ttys[qid.path]
+            self.acquire()
+            buffer += data
+            if len(buffer) > self.TTY_BUFFER:
+                del buffer[:len(buffer) - self.TTY_BUFFER]
+            # the tty changed, caches and read-ahead windows must notice
+            self.bump_version(self.fs[self.qids[qid.path]].qid)
+            self.release()
+        # ignore all other writes
         return len(data)
+
+    def acquire(self):
+        if self.lock is not None:
+            self.lock.acquire()
+
+    def release(self):
+        if self.lock is not None:
+            self.lock.release()
+
+    def is_blocking(self, qid: Qid) -> bool:
+        # reading a tty waits for output
+        return qid.path in self.ttys
@@ -0,0 +1,189 @@
+import sys
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+from .base import Notifier, Qid, Stat, FileSystemDriver, DirectoryCursor
+
+
+class AsyncFileSystemDriver(Notifier):
+    # Same contract as FileSystemDriver, but every call that may touch a
+    # backing store is a coroutine that the AsyncServer awaits.
+
+    def io_size(self) -> int:
+        self.fatal("IMPLEMENT ME: io_size")
+
+    async def reset(self):
+        self.fatal("IMPLEMENT ME: reset")
+
+    async def session_reset(self):
+        # see FileSystemDriver.session_reset
+        pass
+
+    async def get_root(self, name="") -> Qid:
+        self.fatal("IMPLEMENT ME: get_root")
+
+    async def has_entry(self, qid: Qid, name: str) -> bool:
+        self.fatal("IMPLEMENT ME: has_entry")
+
+    async def get_qid(self, qid: Qid, name: str) -> Qid:
+        self.fatal("IMPLEMENT ME: get_qid")
+
+    async def walk_path(self, qid: Qid, names) -> list:
+        # see FileSystemDriver.walk_path
+        qids = []
+        for name in names:
+            if not qid.is_dir() or not await self.has_entry(qid, name):
+                break
+            qid = await self.get_qid(qid, name)
+            qids.append(qid)
+        return qids
+
+    async def get_stat(self, qid: Qid) -> Stat:
+        self.fatal("IMPLEMENT ME: get_stat")
+
+    async def get_version(self, qid: Qid) -> int:
+        return (await self.get_stat(qid)).qid.version
+
+    async def open_file(self, qid: Qid, mode: int):
+        self.fatal("IMPLEMENT ME: open_file")
+
+    async def close_file(self, qid: Qid):
+        self.fatal("IMPLEMENT ME: close_file")
+
+    async def list_dir(self, qid: Qid, index: int):
+        # Optional, see FileSystemDriver.list_dir
+        return None
+
+    async def read_dir(self, cursor: DirectoryCursor, count: int) -> bytearray:
+        # pulls entries out of a list_dir iterator, which may touch the backend
+        return cursor.read(count)
+
+    async def read_file(self, qid: Qid, offset: int, count: int) -> bytearray:
+        self.fatal("IMPLEMENT ME: read_file")
+
+    async def write_file(self, qid: Qid, offset: int, data: bytes) -> int:
+        self.fatal("IMPLEMENT ME: write_file")
+
+    # Optional, see FileSystemDriver.create_file
+    async def create_file(self, qid: Qid, name: str, perm: int, mode: int) -> Qid:
+        self.refuse("Permission denied.")
+
+    async def remove(self, qid: Qid):
+        self.refuse("Permission denied.")
+
+    async def write_stat(self, qid: Qid, stat: Stat):
+        pass
+
+    def is_blocking(self, qid: Qid) -> bool:
+        return False
+
+
+class InlineDriver(AsyncFileSystemDriver):
+    # Runs a synchronous driver on the event loop itself. Only suitable for
+    # drivers that never block, or where there are no threads (micropython).
+
+    def __init__(self, driver: FileSystemDriver):
+        self.driver = driver
+
+    async def call(self, method, *args):
+        return method(*args)
+
+    def io_size(self) -> int:
+        return self.driver.io_size()
+
+    def is_blocking(self, qid: Qid) -> bool:
+        return self.driver.is_blocking(qid)
+
+    # notifications come straight from the wrapped driver
+    def add_listener(self, callback):
+        self.driver.add_listener(callback)
+
+    def remove_listener(self, callback):
+        self.driver.remove_listener(callback)
+
+    async def reset(self):
+        return await self.call(self.driver.reset)
+
+    async def session_reset(self):
+        return await self.call(self.driver.session_reset)
+
+    async def get_root(self, name="") -> Qid:
+        return await self.call(self.driver.get_root)
+
+    async def has_entry(self, qid: Qid, name: str) -> bool:
+        return await self.call(self.driver.has_entry, qid, name)
+
+    async def get_qid(self, qid: Qid, name: str) -> Qid:
+        return await self.call(self.driver.get_qid, qid, name)
+
+    async def walk_path(self, qid: Qid, names) -> list:
+        return await self.call(self.driver.walk_path, qid, names)
+
+    async def get_stat(self, qid: Qid) -> Stat:
+        return await self.call(self.driver.get_stat, qid)
+
+    async def get_version(self, qid: Qid) -> int:
+        return await self.call(self.driver.get_version, qid)
+
+    async def open_file(self, qid: Qid, mode: int):
+        return await self.call(self.driver.open_file, qid, mode)
+
+    async def close_file(self, qid: Qid):
+        return await self.call(self.driver.close_file, qid)
+
+    async def list_dir(self, qid: Qid, index: int):
+        return await self.call(self.driver.list_dir, qid, index)
+
+    async def read_dir(self, cursor: DirectoryCursor, count: int) -> bytearray:
+        return await self.call(cursor.read, count)
+
+    async def read_file(self, qid: Qid, offset: int, count: int) -> bytearray:
+        return await self.call(self.driver.read_file, qid, offset, count)
+
+    async def write_file(self, qid: Qid, offset: int, data: bytes) -> int:
+        return await self.call(self.driver.write_file, qid, offset, data)
+
+    async def create_file(self, qid: Qid, name: str, perm: int, mode: int) -> Qid:
+        return await self.call(self.driver.create_file, qid, name, perm, mode)
+
+    async def remove(self, qid: Qid):
+        return await self.call(self.driver.remove, qid)
+
+    async def write_stat(self, qid: Qid, stat: Stat):
+        return await self.call(self.driver.write_stat, qid, stat)
+
+
+class ExecutorDriver(InlineDriver):
+    # Runs a synchronous driver on a bounded thread pool so that slow backend
+    # calls from concurrent requests overlap instead of queueing up.
+    # The wrapped driver must therefore be thread safe.
+
+    def __init__(self, driver: FileSystemDriver, max_workers=4):
+        from concurrent.futures import ThreadPoolExecutor
+        super().__init__(driver)
+        self.executor = ThreadPoolExecutor(max_workers)
+
+    async def call(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, method, *args)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def as_async_driver(driver, max_workers=4) -> AsyncFileSystemDriver:
+    if isinstance(driver, AsyncFileSystemDriver):
+        return driver
+    # one wrapper per driver, so every connection using it shares one
+    # executor instead of leaving a thread pool behind each
+    wrapper = getattr(driver, "async_driver", None)
+    if wrapper is None:
+        if sys.implementation.name == "micropython":
+            wrapper = InlineDriver(driver)
+        else:
+            wrapper = ExecutorDriver(driver, max_workers)
+        driver.async_driver = wrapper
+    return wrapper
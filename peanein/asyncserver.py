@@ -0,0 +1,619 @@
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+from peanein.base import DirectoryCursor
+from peanein.server import Server
+from peanein.asyncdriver import as_async_driver
+
+
+class ReadAhead:
+    # Prefetch state of one open fid, see AsyncServer.read_ahead_file
+    def __init__(self):
+        self.next = None  # offset a sequential Tread would ask for next
+        self.count = 0  # and how much it would ask for
+        self.window = {}  # offset -> task reading count bytes there
+
+
+class AsyncServer(Server):
+    # Every T-message that has to consult the driver runs as its own task,
+    # keyed by tag, so a slow driver call does not hold up the connection.
+    # The channel is an asyncio StreamWriter, replies are buffered by it.
+    #
+    # Backpressure: no new message is read while max_inflight requests are
+    # running, or while the replies they may produce (max_queued bytes,
+    # counting the count of every Tread) or the replies the transport has
+    # not sent yet go over budget. Reads parked on a blocking file hold no
+    # buffer and give up their slot, so they can't wedge the connection;
+    # instead at most max_parked of them may wait at once, and one that
+    # wakes takes a slot and its reply bytes again.
+    #
+    # Read-ahead: once a fid is read sequentially, the next read_ahead
+    # chunks of the same size are fetched in the background while the reply
+    # goes out. Prefetches count as requests in flight and against
+    # max_queued, never take the last slot, and at most read_ahead of them
+    # run per connection, so they can't crowd out requests or the shared
+    # executor. A window is dropped when the driver bumps the file's
+    # version, which notifies us, so writes from other connections count too.
+
+    def __init__(self, reader, writer, filesystem_driver, max_size=8192, codec=None, trees=None,
+                 max_inflight=16, max_queued=256 * 1024, read_ahead=2, max_parked=None):
+        # register AsyncFileSystemDrivers (e.g. an ExecutorDriver) in trees
+        # shared between connections, or each connection wraps its own
+        super().__init__(writer, as_async_driver(filesystem_driver), max_size, codec, trees=trees)
+        self._reader = reader
+        self.requests = {}
+        # a flush may only cancel what has changed nothing yet, the rest
+        # reply before the Rflush
+        self.cancellable = set()  # tasks not started yet, or parked
+        self.flushed = set()  # started tasks a Tflush waits for
+        self.opening = {}  # fid -> Topen or Tcreate task, clunk and remove wait for it
+        self.async_trees = {}
+        self.waiters = {}  # (driver, qid path) -> Events of reads parked on it
+        self.listening = []  # (driver, callback) we get notifications from
+        self.loop = None
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.holding = {}  # task -> reply bytes reserved, while it takes a slot
+        self.reserved = 0
+        self.room = asyncio.Event()
+        self.max_parked = max_inflight if max_parked is None else max_parked
+        self.parked_reads = 0
+        self.read_ahead = read_ahead
+        self.read_aheads = {}  # fid -> ReadAhead
+        self.prefetching = 0  # prefetch tasks holding a slot
+        self.counters = {"requests": 0, "stalls": 0, "parked": 0,
+                         "peak_inflight": 0, "peak_reserved": 0,
+                         "prefetched": 0, "prefetch_hits": 0, "prefetch_dropped": 0}
+
+    def get_tree(self, aname: str):
+        driver = super().get_tree(aname)
+        if driver is None:
+            return None
+        if aname not in self.async_trees:
+            self.async_trees[aname] = as_async_driver(driver)
+        return self.async_trees[aname]
+
+    def write(self, data):
+        # data is a view of the transmit buffer, which is reused for the next
+        # reply, while the transport may hold on to what it can't send yet
+        self._channel.write(bytes(data))
+
+    async def receive_async(self):
+        head = await self._reader.readexactly(7)
+        size = self.parse_uint(head, 0, 4)
+        verb = self.parse_uint(head, 4, 1)
+        tag = self.parse_uint(head, 5, 2)
+        if (size + 4) > self._max_size:
+            self.fatal("Packet is oversized.")
+        # read rest of packet
+        data = await self._reader.readexactly(size - 7)
+        return verb, tag, data
+
+    async def serve(self):
+        self.loop = asyncio.get_event_loop()
+        transport = getattr(self._channel, "transport", None)
+        if transport is not None and hasattr(transport, "set_write_buffer_limits"):
+            # drain() then waits for unsent replies to go below the budget
+            transport.set_write_buffer_limits(high=self.max_queued)
+        try:
+            while True:
+                await self.admit()
+                verb, tag, data = await self.receive_async()
+                self.dispatch(verb, tag, data)
+        finally:
+            self.cancel_requests()
+            await self.close_fids()
+            for driver, callback in self.listening:
+                driver.remove_listener(callback)
+            self.listening = []
+
+    async def admit(self):
+        # wait for room before reading the next message
+        if self.over_limit():
+            self.counters["stalls"] += 1
+        while self.over_limit():
+            self.room.clear()
+            await self.room.wait()
+        await self._channel.drain()
+
+    def over_limit(self) -> bool:
+        return len(self.holding) >= self.max_inflight or self.reserved > self.max_queued
+
+    def reserve(self, task, size):
+        self.holding[task] += size
+        self.reserved += size
+        if self.reserved > self.counters["peak_reserved"]:
+            self.counters["peak_reserved"] = self.reserved
+
+    def release(self, task):
+        if task in self.holding:
+            self.free(self.holding.pop(task))
+
+    def free(self, size):
+        self.reserved -= size
+        self.room.set()
+
+    def stats(self) -> dict:
+        out = dict(self.counters)
+        out["inflight"] = len(self.holding)
+        out["requests_open"] = len(self.requests)
+        out["reserved"] = self.reserved
+        out["parked_reads"] = self.parked_reads
+        out["max_inflight"] = self.max_inflight
+        out["max_queued"] = self.max_queued
+        transport = getattr(self._channel, "transport", None)
+        if transport is not None and hasattr(transport, "get_write_buffer_size"):
+            out["unsent"] = transport.get_write_buffer_size()
+        return out
+
+    def listen(self, driver):
+        # qid paths are only unique within a driver, so every driver gets a
+        # callback of its own that knows which one it is
+        for listening, _ in self.listening:
+            if listening is driver:
+                return
+        callback = lambda path: self.wake(driver, path)
+        driver.add_listener(callback)
+        self.listening.append((driver, callback))
+
+    def wake(self, driver, path):
+        # drivers may notify from an executor thread
+        call = getattr(self.loop, "call_soon_threadsafe", None)
+        if call is None:
+            self.wake_waiters((driver, path))
+        else:
+            call(self.wake_waiters, (driver, path))
+
+    def wake_waiters(self, key):
+        # key is (driver, qid path) of a file that changed or has data
+        for event in self.waiters.pop(key, []):
+            event.set()
+        for fid in list(self.read_aheads.keys()):
+            qid = self.get_fid(fid)
+            if qid is None or (self.driver_for(fid) is key[0] and qid.path == key[1]):
+                self.drop_read_ahead(fid)
+
+    async def read_blocking(self, driver, qid, offset, count):
+        # Park until the driver has data. Flush or disconnect cancel the
+        # request, which ends the wait, and so does a flush that came while
+        # the read was still running. The event is registered before the
+        # read so a notify in between can't be missed.
+        key = (driver, qid.path)
+        task = asyncio.current_task()
+        parked = False
+        try:
+            while True:
+                event = asyncio.Event()
+                self.waiters.setdefault(key, []).append(event)
+                try:
+                    buffer = await driver.read_file(qid, offset, count)
+                    if len(buffer) > 0:
+                        return buffer
+                    if task in self.flushed:
+                        raise asyncio.CancelledError()
+                    if not parked:
+                        if self.parked_reads >= self.max_parked:
+                            self.refuse(self.E_TOO_MANY_WAITING)
+                        parked = True
+                        self.parked_reads += 1
+                        self.counters["parked"] += 1
+                    self.release(task)
+                    self.cancellable.add(task)
+                    await event.wait()
+                    self.cancellable.discard(task)
+                    # awake: the read runs again and so may reply
+                    self.holding[task] = 0
+                    self.reserve(task, 11 + count)
+                finally:
+                    self.cancellable.discard(task)
+                    waiting = self.waiters.get(key)
+                    if waiting is not None and event in waiting:
+                        waiting.remove(event)
+                        if len(waiting) == 0:
+                            del self.waiters[key]
+        finally:
+            if parked:
+                self.parked_reads -= 1
+
+    def spawn(self, tag, method, *args):
+        task = asyncio.create_task(self.respond(tag, method, args))
+        self.requests[tag] = task
+        self.cancellable.add(task)
+        self.holding[task] = 0
+        self.counters["requests"] += 1
+        if len(self.holding) > self.counters["peak_inflight"]:
+            self.counters["peak_inflight"] = len(self.holding)
+        return task
+
+    async def respond(self, tag, method, args):
+        task = asyncio.current_task()
+        self.cancellable.discard(task)
+        try:
+            await method(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.Error(tag, str(e))
+        finally:
+            # the tag may already belong to a newer request
+            if self.requests.get(tag) is task:
+                del self.requests[tag]
+            self.release(task)
+
+    def cancel_requests(self):
+        requests = self.requests
+        self.requests = {}
+        for request in requests.values():
+            self.cancel(request)
+
+    def cancel(self, task):
+        # a task cancelled before it ever ran skips the finally in respond
+        task.cancel()
+        self.cancellable.discard(task)
+        self.release(task)
+
+    def del_fid(self, fid: int):
+        self.drop_read_ahead(fid)
+        super().del_fid(fid)
+
+    async def close_fids(self):
+        for fid in list(self.read_aheads.keys()):
+            self.drop_read_ahead(fid)
+        self.opening = {}
+        fids = self.fids
+        fid_trees = self.fid_trees
+        self.fids = {}
+        self.fid_trees = {}
+        self.dir_cursors = {}
+        for fid in fids.keys():
+            qid = fids[fid]
+            if qid.is_opened():
+                await fid_trees[fid].close_file(qid)
+
+    def ServerVersion(self, tag, msize, version):
+        # a new session, see Server.ServerVersion. A version we can't talk
+        # ends the connection here, as it does there, rather than in a task.
+        if not version.startswith(self.VERSION):
+            self.Error(tag, self.E_9P2000_ONLY, fatal=True)
+        self.cancel_requests()
+        self.spawn(tag, self.do_version, tag, msize, version)
+
+    async def do_version(self, tag, msize, version):
+        await self.close_fids()
+        await self.filesystem_driver.session_reset()
+        attached = self.attached
+        self.attached = []
+        for driver in attached:
+            await driver.session_reset()
+        self.negotiate_version(tag, msize, version)
+
+    def ServerAttach(self, tag, fid, afid, uname, aname):
+        if afid != self.NOFID:
+            self.Error(tag, self.E_NEED_NOFID)
+            return
+        # aname picks the tree
+        driver = self.get_tree(aname or "")
+        if driver is None:
+            self.Error(tag, self.E_NO_ALT_ROOT)
+            return
+        self.spawn(tag, self.do_attach, tag, fid, driver)
+
+    async def do_attach(self, tag, fid, driver):
+        qid = await driver.get_root()
+        self.listen(driver)
+        if driver is not self.filesystem_driver and driver not in self.attached:
+            self.attached.append(driver)
+        self.add_fid(fid, qid.duplicate(), driver)
+        self.ClientAttach(tag, qid)
+
+    def ServerWalk(self, tag, fid, newfid, wname_array):
+        self.spawn(tag, self.do_walk, tag, fid, newfid, wname_array)
+
+    async def do_walk(self, tag, fid, newfid, wname_array):
+        qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
+        if qid is None:
+            self.Error(tag, self.E_INVALID_FID)
+            return
+        if self.exists_fid(newfid):
+            self.Error(tag, self.E_DUPLICATE_FID)
+            return
+        if qid.is_opened():
+            self.Error(tag, self.E_ALREADY_OPEN)
+            return
+        if len(wname_array) == 0:
+            self.add_fid(newfid, qid.duplicate(), driver)
+            self.ClientWalk(tag, [])
+            return
+        if not qid.is_dir():
+            self.Error(tag, self.E_NOT_DIR)
+            return
+        qid_array = await driver.walk_path(qid, wname_array)
+        if len(qid_array) == 0:
+            self.Error(tag, self.E_NOT_FOUND)
+            return
+        if len(qid_array) == len(wname_array):
+            self.add_fid(newfid, qid_array[-1].duplicate(), driver)
+        self.ClientWalk(tag, qid_array)
+
+    def ServerClunk(self, tag, fid):
+        opening = self.opening.pop(fid, None)
+        if opening is not None and not opening.done():
+            # or what it opens is left open with no fid to close it
+            self.spawn(tag, self.do_clunk_after, tag, fid, opening)
+            return
+        qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
+        self.del_fid(fid)
+        if qid is not None and qid.is_opened():
+            self.spawn(tag, self.do_clunk, tag, qid, driver)
+        else:
+            self.ClientClunk(tag)
+
+    async def do_clunk(self, tag, qid, driver):
+        await driver.close_file(qid)
+        self.ClientClunk(tag)
+
+    async def do_clunk_after(self, tag, fid, opening):
+        await asyncio.gather(opening, return_exceptions=True)
+        qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
+        self.del_fid(fid)
+        if qid is not None and qid.is_opened():
+            await self.do_clunk(tag, qid, driver)
+        else:
+            self.ClientClunk(tag)
+
+    def ServerStat(self, tag, fid):
+        self.spawn(tag, self.do_stat, tag, fid)
+
+    async def do_stat(self, tag, fid):
+        qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
+        if qid is None:
+            self.Error(tag, self.E_INVALID_FID)
+            return
+        stat = await driver.get_stat(qid)
+        self.ClientStat(tag, stat)
+
+    def ServerOpen(self, tag, fid, mode):
+        self.opening[fid] = self.spawn(tag, self.do_open, tag, fid, mode)
+
+    async def do_open(self, tag, fid, mode):
+        if not self.exists_fid(fid):
+            self.Error(tag, self.E_INVALID_FID)
+            return
+        qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
+        if qid.is_opened():
+            self.Error(tag, self.E_ALREADY_OPEN)
+            return
+        await self.open_fid(fid, qid, mode)
+        self.ClientOpen(tag, qid, driver.io_size())
+
+    async def open_fid(self, fid, qid, mode):
+        driver = self.driver_for(fid)
+        await driver.open_file(qid, mode)
+        # the fid's copy of the qid may predate changes since the walk
+        qid.version = await driver.get_version(qid)
+        if qid.is_dir():
+            entries = await driver.list_dir(qid, 0)
+            if entries is not None:
+                self.dir_cursors[fid] = DirectoryCursor(entries)
+
+    def ServerCreate(self, tag, fid, name, perm, mode):
+        self.opening[fid] = self.spawn(tag, self.do_create, tag, fid, name, perm, mode)
+
+    async def do_create(self, tag, fid, name, perm, mode):
+        if not self.exists_fid(fid):
+            self.Error(tag, self.E_INVALID_FID)
+            return
+        qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
+        if qid.is_opened():
+            self.Error(tag, self.E_ALREADY_OPEN)
+            return
+        if not qid.is_dir():
+            self.Error(tag, self.E_NOT_DIR)
+            return
+        created = (await driver.create_file(qid, name, perm, mode)).duplicate()
+        await self.open_fid(fid, created, mode)
+        self.fids[fid] = created
+        self.ClientCreate(tag, created, driver.io_size())
+
+    def ServerRemove(self, tag, fid):
+        opening = self.opening.pop(fid, None)
+        if opening is not None and not opening.done():
+            self.spawn(tag, self.do_remove_after, tag, fid, opening)
+            return
+        if not self.exists_fid(fid):
+            self.Error(tag, self.E_INVALID_FID)
+            return
+        qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
+        self.del_fid(fid)
+        self.spawn(tag, self.do_remove, tag, qid, driver)
+
+    async def do_remove(self, tag, qid, driver):
+        opened = qid.is_opened()
+        try:
+            await driver.remove(qid)
+        finally:
+            if opened:
+                await driver.close_file(qid)
+        self.ClientRemove(tag)
+
+    async def do_remove_after(self, tag, fid, opening):
+        await asyncio.gather(opening, return_exceptions=True)
+        if not self.exists_fid(fid):
+            self.Error(tag, self.E_INVALID_FID)
+            return
+        qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
+        self.del_fid(fid)
+        await self.do_remove(tag, qid, driver)
+
+    def ServerWriteStat(self, tag, fid, stat):
+        self.drop_read_aheads_of(fid)
+        self.spawn(tag, self.do_write_stat, tag, fid, stat)
+
+    async def do_write_stat(self, tag, fid, stat):
+        qid = self.get_fid(fid)
+        if qid is None:
+            self.Error(tag, self.E_INVALID_FID)
+            return
+        await self.driver_for(fid).write_stat(qid, stat)
+        self.ClientWriteStat(tag)
+
+    def ServerRead(self, tag, fid, offset, count):
+        task = self.spawn(tag, self.do_read, tag, fid, offset, count)
+        # size[4] Rread tag[2] count[4] data[count]
+        self.reserve(task, 11 + self.clip_read(count))
+
+    async def do_read(self, tag, fid, offset, count):
+        if not self.exists_fid(fid):
+            self.Error(tag, self.E_INVALID_FID)
+            return
+        qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
+        if not qid.is_opened():
+            self.Error(tag, self.E_NOT_OPEN)
+            return
+        wanted = count
+        count = self.clip_read(count)
+        if count == 0 and wanted > 0:
+            self.Error(tag, self.E_COUNT_TOO_SMALL)
+            return
+        cursor = self.dir_cursors.get(fid)
+        if cursor is None:
+            if driver.is_blocking(qid):
+                buffer = await self.read_blocking(driver, qid, offset, count)
+            elif self.read_ahead > 0:
+                buffer = await self.read_ahead_file(fid, driver, qid, offset, count)
+            else:
+                buffer = await driver.read_file(qid, offset, count)
+        else:
+            if offset == 0 and cursor.offset != 0:
+                entries = await driver.list_dir(qid, 0)
+                cursor = DirectoryCursor(entries)
+                self.dir_cursors[fid] = cursor
+            elif offset != cursor.offset:
+                self.Error(tag, self.E_BAD_OFFSET)
+                return
+            buffer = await driver.read_dir(cursor, count)
+            if buffer is None:
+                self.Error(tag, self.E_COUNT_TOO_SMALL)
+                return
+        self.ClientRead(tag, buffer)
+
+    async def read_ahead_file(self, fid, driver, qid, offset, count):
+        ahead = self.read_aheads.get(fid)
+        if ahead is None:
+            ahead = ReadAhead()
+            self.read_aheads[fid] = ahead
+        sequential = offset == ahead.next and count == ahead.count
+        if not sequential:
+            self.drop_window(ahead)
+        # expect the next read before awaiting, pipelined Treads then still
+        # look sequential
+        ahead.next = offset + count
+        ahead.count = count
+        task = ahead.window.pop(offset, None)
+        buffer = None
+        if task is not None:
+            self.unfetch(task)
+            buffer = await task
+            if buffer is not None:
+                self.counters["prefetch_hits"] += 1
+        if buffer is None:
+            buffer = await driver.read_file(qid, offset, count)
+        if sequential and len(buffer) == count and self.read_aheads.get(fid) is ahead:
+            self.prefetch(ahead, driver, qid)
+        return buffer
+
+    def prefetch(self, ahead, driver, qid):
+        offset = ahead.next
+        while len(ahead.window) < self.read_ahead:
+            if offset not in ahead.window:
+                if self.prefetching >= self.read_ahead or len(self.holding) >= self.max_inflight - 1:
+                    break
+                if self.reserved + ahead.count > self.max_queued:
+                    break
+                task = asyncio.create_task(self.fetch(driver, qid, offset, ahead.count))
+                self.holding[task] = 0
+                self.reserve(task, ahead.count)
+                self.prefetching += 1
+                ahead.window[offset] = task
+                self.counters["prefetched"] += 1
+            offset += ahead.count
+
+    def unfetch(self, task):
+        # a prefetch was used or dropped, its slot and bytes are free again
+        self.release(task)
+        self.prefetching -= 1
+
+    async def fetch(self, driver, qid, offset, count):
+        try:
+            return await driver.read_file(qid, offset, count)
+        except Exception:
+            return None  # read again if asked for, the error is reported then
+
+    def drop_window(self, ahead):
+        for task in ahead.window.values():
+            task.cancel()
+            self.unfetch(task)
+            self.counters["prefetch_dropped"] += 1
+        ahead.window = {}
+
+    def drop_read_ahead(self, fid):
+        ahead = self.read_aheads.pop(fid, None)
+        if ahead is not None:
+            self.drop_window(ahead)
+
+    def drop_read_aheads_of(self, fid):
+        # prefetched data of every fid on the same file is about to be stale
+        qid = self.get_fid(fid)
+        if qid is None:
+            return
+        for other in list(self.read_aheads.keys()):
+            other_qid = self.get_fid(other)
+            if other_qid is None or other_qid.path == qid.path:
+                self.drop_read_ahead(other)
+
+    def ServerWrite(self, tag, fid, offset, buffer):
+        self.drop_read_aheads_of(fid)
+        self.spawn(tag, self.do_write, tag, fid, offset, buffer)
+
+    async def do_write(self, tag, fid, offset, buffer):
+        if not self.exists_fid(fid):
+            self.Error(tag, self.E_INVALID_FID)
+            return
+        qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
+        if not qid.is_opened():
+            self.Error(tag, self.E_NOT_OPEN)
+            return
+        count = await driver.write_file(qid, offset, buffer)
+        self.ClientWrite(tag, count)
+
+    def ServerFlush(self, tag, oldtag):
+        request = self.requests.get(oldtag)
+        if request is not None and request not in self.cancellable:
+            # the driver may already be at it: let it reply, then Rflush
+            self.spawn(tag, self.do_flush, tag, request)
+            return
+        # nothing done yet, cancel it and its reply will never be sent
+        if request is not None:
+            del self.requests[oldtag]
+            self.cancel(request)
+        self.ClientFlush(tag)
+
+    async def do_flush(self, tag, request):
+        self.flushed.add(request)
+        try:
+            await asyncio.gather(request, return_exceptions=True)
+        finally:
+            self.flushed.discard(request)
+        self.ClientFlush(tag)
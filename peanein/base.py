@@ -1,4 +1,11 @@
 import sys
+import struct
+
+class DriverError(Exception):
+    # A request the driver turned down. The server answers it with an Rerror
+    # carrying the text, unlike fatal() which ends the connection.
+    pass
+
 
 class Util:
     def fatal(self, text: str):
@@ -7,13 +14,31 @@ class Util:
         else:
             raise IOError(text)
 
+    def refuse(self, text: str):
+        raise DriverError(text)
+
 
 class Marshalling(Util):
-    def parse_uint(self, data, ptr, size) -> int:
-        if (ptr + size) > len(data):
-            self.fatal("parse_uint: bad size.")
-        # return int.from_bytes(data[ptr:ptr + size], 'little', signed=False)
-        return int.from_bytes(data[ptr:ptr + size], 'little')
+    UINT_FORMATS = {1: '<B', 2: '<H', 4: '<I', 8: '<Q'}
+
+    if sys.implementation.name == "micropython":
+        def parse_uint(self, data, ptr, size) -> int:
+            if (ptr + size) > len(data):
+                self.fatal("parse_uint: bad size.")
+            # byte at a time rather than int.from_bytes(data[ptr:ptr + size]),
+            # slicing allocates and data is often a memoryview of the rx buffer
+            value = 0
+            i = ptr + size
+            while i > ptr:
+                i -= 1
+                value = (value << 8) | data[i]
+            return value
+    else:
+        def parse_uint(self, data, ptr, size) -> int:
+            if (ptr + size) > len(data):
+                self.fatal("parse_uint: bad size.")
+            # on cpython the slice is cheaper than a loop in bytecode
+            return int.from_bytes(data[ptr:ptr + size], 'little')
 
     def parse_string(self, data, ptr) -> (int, str):
         size = self.parse_uint(data, ptr, 2)
@@ -21,7 +46,7 @@ class Marshalling(Util):
         if size > (len(data) - ptr):
             self.fatal("parse_string: bad size.")
         text = data[ptr:ptr + size]
-        return size, text.decode('utf-8')
+        return size, str(text, 'utf-8')
 
     def parse_qid(self, data, ptr):
         if (len(data) - ptr) < 13:
@@ -39,8 +64,8 @@ class Marshalling(Util):
         mode = self.parse_uint(data, ptr + 21, 4)
         atime = self.parse_uint(data, ptr + 25, 4)
         mtime = self.parse_uint(data, ptr + 29, 4)
-        length = self.parse_uint(data, ptr + 33, 4)
-        ptr = ptr + 37
+        length = self.parse_uint(data, ptr + 33, 8)
+        ptr = ptr + 41
         n, name = self.parse_string(data, ptr)
         ptr += n + 2
         n, uid = self.parse_string(data, ptr)
@@ -60,6 +85,22 @@ class Marshalling(Util):
         data = size + bin_text
         return data
 
+    # pack_* encode in place into a preallocated buffer and return the
+    # pointer just past what they wrote.
+    def pack_uint(self, buf, ptr, num, size) -> int:
+        struct.pack_into(self.UINT_FORMATS[size], buf, ptr, num)
+        return ptr + size
+
+    def pack_bytes(self, buf, ptr, data) -> int:
+        end = ptr + len(data)
+        buf[ptr:end] = data
+        return end
+
+    def pack_string(self, buf, ptr, text) -> int:
+        data = text.encode('utf-8')
+        ptr = self.pack_uint(buf, ptr, len(data), 2)
+        return self.pack_bytes(buf, ptr, data)
+
 
 class Qid(Marshalling):
     QTDIR = 0x80  # /* type bit for directories */
@@ -82,14 +123,15 @@ class Qid(Marshalling):
         self.version = version
 
     def serialize(self):
-        # data = bytearray(self.type.to_bytes(1, byteorder='little', signed=False))
-        # data += bytearray(self.version.to_bytes(4, byteorder='little', signed=False))
-        # data += bytearray(self.path.to_bytes(8, byteorder='little', signed=False))
-        data = self.serialize_uint(self.type, 1)
-        data += self.serialize_uint(self.version, 4)
-        data += self.serialize_uint(self.path, 8)
+        data = bytearray(13)
+        self.serialize_into(data, 0)
         return data
 
+    def serialize_into(self, buf, ptr) -> int:
+        ptr = self.pack_uint(buf, ptr, self.type, 1)
+        ptr = self.pack_uint(buf, ptr, self.version, 4)
+        return self.pack_uint(buf, ptr, self.path, 8)
+
     def is_mode(self, mode):
         return (mode & self.type) == mode
 
@@ -135,23 +177,35 @@ class Stat(Marshalling):
             if self.qid.is_mode(Qid.QTEXCL):
                 self.mode |= Stat.EXCL
 
+    def size(self) -> int:
+        # encoded size, including the leading size[2]
+        size = 49
+        for text in (self.name, self.uid, self.gid, self.muid):
+            size += len(text.encode('utf-8'))
+        return size
+
     def serialize(self) -> bytearray:
-        data = self.serialize_uint(self.type, 2)
-        data += self.serialize_uint(self.dev, 4)
-        data += self.qid.serialize()
-        data += self.serialize_uint(self.mode, 4)
-        data += self.serialize_uint(self.atime, 4)
-        data += self.serialize_uint(self.mtime, 4)
-        data += self.serialize_uint(self.length, 8)
-        data += self.str_to_pas(self.name)
-        data += self.str_to_pas(self.uid)
-        data += self.str_to_pas(self.gid)
-        data += self.str_to_pas(self.muid)
-        size = len(data)
-        data = self.serialize_uint(size, 2) + data
-        # data = self.serialize_uint(size+2, 2) + data
+        data = bytearray(self.size())
+        self.serialize_into(data, 0)
         return data
 
+    def serialize_into(self, buf, ptr) -> int:
+        start = ptr
+        ptr = self.pack_uint(buf, ptr + 2, self.type, 2)
+        ptr = self.pack_uint(buf, ptr, self.dev, 4)
+        ptr = self.qid.serialize_into(buf, ptr)
+        ptr = self.pack_uint(buf, ptr, self.mode, 4)
+        ptr = self.pack_uint(buf, ptr, self.atime, 4)
+        ptr = self.pack_uint(buf, ptr, self.mtime, 4)
+        ptr = self.pack_uint(buf, ptr, self.length, 8)
+        ptr = self.pack_string(buf, ptr, self.name)
+        ptr = self.pack_string(buf, ptr, self.uid)
+        ptr = self.pack_string(buf, ptr, self.gid)
+        ptr = self.pack_string(buf, ptr, self.muid)
+        # size doesn't count itself
+        self.pack_uint(buf, start, ptr - start - 2, 2)
+        return ptr
+
     def to_str(self) -> str:
         return "Stat: type:%02x,dev:%04x,qid(%s),mode=%04x,atime=%d,mtime=%d,length=%d,name=%s,uid=%s,gid=%s,mid=%s" % (
             self.type, self.dev, self.qid.to_str(),
@@ -159,13 +213,69 @@ class Stat(Marshalling):
             self.name, self.uid, self.gid, self.muid)
 
 
-class FileSystemDriver(Util):
+class DirectoryCursor:
+    # Server side state of a directory read: encodes entries on demand so at
+    # most one packet worth of stat records is held in memory at any time.
+    def __init__(self, entries):
+        self.entries = entries
+        self.offset = 0  # byte offset the next Tread must ask for
+        self.index = 0  # number of entries handed out
+        self.pending = None  # encoded entry that did not fit the last read
+
+    def read(self, count):
+        data = bytearray()
+        while True:
+            if self.pending is None:
+                stat = next(self.entries, None)
+                if stat is None:
+                    break
+                self.pending = stat.serialize()
+            if len(data) + len(self.pending) > count:
+                if len(data) == 0:
+                    return None  # count can't hold a single entry
+                break
+            data += self.pending
+            self.pending = None
+            self.index += 1
+        self.offset += len(data)
+        return data
+
+
+class Notifier(Util):
+    # Lets a driver tell servers that a file changed, or that a blocking file
+    # has something to read. Listeners are called with the qid path,
+    # possibly from another thread, and must be cheap.
+    listeners = None
+
+    def add_listener(self, callback):
+        if self.listeners is None:
+            self.listeners = []
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if self.listeners is not None and callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def notify(self, qid: Qid):
+        if self.listeners is not None:
+            for callback in self.listeners:
+                callback(qid.path)
+
+
+class FileSystemDriver(Notifier):
     def io_size(self) -> int:
         self.fatal("IMPLEMENT ME: io_size")
 
     def reset(self):
         self.fatal("IMPLEMENT ME: reset")
 
+    def session_reset(self):
+        # Called on every Tversion once the server has closed that session's
+        # fids. A driver may be shared between sessions and connections, so
+        # this does nothing by default. Drivers that keep state per session
+        # override it to drop just that.
+        pass
+
     def get_root(self, name="") -> Qid:
         self.fatal("IMPLEMENT ME: get_root")
 
@@ -175,17 +285,89 @@ class FileSystemDriver(Util):
     def get_qid(self, qid: Qid, name: str) -> Qid:
         self.fatal("IMPLEMENT ME: get_qid")
 
+    def walk_path(self, qid: Qid, names) -> list:
+        # Resolve names one after the other starting at qid, stopping at the
+        # first one that can't be walked. Returns the qids reached. Drivers
+        # that can resolve a whole path at once should override this.
+        qids = []
+        for name in names:
+            if not qid.is_dir() or not self.has_entry(qid, name):
+                break
+            qid = self.get_qid(qid, name)
+            qids.append(qid)
+        return qids
+
     def get_stat(self, qid: Qid) -> Stat:
         self.fatal("IMPLEMENT ME: get_stat")
 
+    def get_version(self, qid: Qid) -> int:
+        # The server hands each fid its own copy of a qid, so it asks for the
+        # current version before reporting one. Cheaper lookups welcome.
+        return self.get_stat(qid).qid.version
+
+    def bump_version(self, qid: Qid):
+        # Drivers call this on their own qid whenever the data or metadata
+        # behind it changes, which is what lets clients cache. Listeners are
+        # told too, servers drop what they read ahead of it.
+        qid.version = (qid.version + 1) & 0xffffffff
+        self.notify(qid)
+
     def open_file(self, qid: Qid, mode: int):
         self.fatal("IMPLEMENT ME: open_file")
 
     def close_file(self, qid: Qid):
         self.fatal("IMPLEMENT ME: close_file")
 
+    def list_dir(self, qid: Qid, index: int):
+        # Optional: return an iterator of Stat for the entries of an opened
+        # directory, starting at entry number index. Returning None means
+        # the driver serves directory contents through read_file instead.
+        return None
+
     def read_file(self, qid: Qid, offset: int, count: int) -> bytearray:
         self.fatal("IMPLEMENT ME: read_file")
 
     def write_file(self, qid: Qid, offset: int, data: bytes) -> int:
         self.fatal("IMPLEMENT ME: write_file")
+
+    # Optional: drivers with a writable namespace implement these, and
+    # refuse() whatever they won't do.
+    def create_file(self, qid: Qid, name: str, perm: int, mode: int) -> Qid:
+        # make name in the directory qid, returns the qid of the new entry,
+        # which the server then opens with mode
+        self.refuse("Permission denied.")
+
+    def remove(self, qid: Qid):
+        # the server has already closed qid if it was open
+        self.refuse("Permission denied.")
+
+    def write_stat(self, qid: Qid, stat: Stat):
+        # Twstat: fields of stat that are ~0, or "" for strings, are left
+        # alone. The default accepts and ignores it, as the server always did.
+        pass
+
+    def is_blocking(self, qid: Qid) -> bool:
+        # Optional: reads of a blocking file that return no data are parked
+        # by the AsyncServer until the driver calls notify(qid) for it.
+        # The plain Server just returns the empty read.
+        return False
+
+
+class TreeRegistry(Util):
+    # Maps attach names (aname) to the driver exporting that tree. A registry
+    # is meant to be shared by all connections, so each tree is built once.
+    def __init__(self):
+        self.trees = {}
+
+    def register(self, aname: str, driver):
+        self.trees[aname] = driver
+
+    def unregister(self, aname: str):
+        if aname in self.trees:
+            del self.trees[aname]
+
+    def get(self, aname: str):
+        return self.trees.get(aname)
+
+    def names(self) -> list:
+        return list(self.trees.keys())
@@ -0,0 +1,74 @@
+import io
+
+from .base import Util
+
+# Raw deflate with a 512 byte window, the smallest cpython's zlib makes.
+# Both ends must agree on it: a decoder with a smaller window can't follow
+# the back references of a larger one.
+WBITS = 9
+
+
+class Codec(Util):
+    # Payload codec for the 9P2000.z extension, see Protocol.pack_payload
+    def compress(self, data) -> bytes:
+        self.fatal("IMPLEMENT ME: compress")
+
+    def decompress(self, data, limit) -> bytes:
+        # at most limit bytes, more is fatal
+        self.fatal("IMPLEMENT ME: decompress")
+
+
+class ZlibDeflate(Codec):
+    # cpython: raw deflate at the cheapest level
+    def __init__(self, level=1):
+        import zlib
+        self.zlib = zlib
+        self.compressobj = zlib.compressobj  # micropython's zlib can't compress
+        self.level = level
+
+    def compress(self, data) -> bytes:
+        c = self.compressobj(self.level, self.zlib.DEFLATED, -WBITS)
+        return c.compress(data) + c.flush()
+
+    def decompress(self, data, limit) -> bytes:
+        d = self.zlib.decompressobj(-WBITS)
+        out = d.decompress(data, limit + 1)
+        if len(out) > limit or len(d.unconsumed_tail) > 0:
+            self.fatal("decompress: payload inflates past %d bytes." % limit)
+        return out
+
+
+class MicroPythonDeflate(Codec):
+    # micropython 1.21+, needs a port built with MICROPY_PY_DEFLATE_COMPRESS
+    def __init__(self):
+        import deflate
+        self.deflate = deflate
+
+    def compress(self, data) -> bytes:
+        out = io.BytesIO()
+        with self.deflate.DeflateIO(out, self.deflate.RAW, WBITS) as f:
+            f.write(data)
+        return out.getvalue()
+
+    def decompress(self, data, limit) -> bytes:
+        with self.deflate.DeflateIO(io.BytesIO(data), self.deflate.RAW, WBITS) as f:
+            out = f.read(limit + 1)
+        if len(out) > limit:
+            self.fatal("decompress: payload inflates past %d bytes." % limit)
+        return out
+
+
+def deflate_codec():
+    # returns None when this runtime can't compress, the server then only
+    # ever offers plain 9P2000
+    try:
+        return ZlibDeflate()
+    except (ImportError, AttributeError):
+        pass
+    try:
+        codec = MicroPythonDeflate()
+        codec.compress(b"probe")
+        return codec
+    except Exception:
+        pass
+    return None
@@ -0,0 +1,270 @@
+import os
+import struct
+
+from .base import Marshalling, FileSystemDriver, Qid, Stat
+from .protocol import Protocol
+
+# A packed image is a read only tree built once and served without parsing:
+#
+#   header   magic[8] count[4] reserved[4]
+#   entries  count * ENTRY, entry 0 is the root, qid.path is the entry index
+#   names    name bytes of every entry
+#   stats    pre-encoded stat records, as sent in Rstat and directory reads
+#   data     contents of the files
+#
+# Entries are laid out breadth first so the children of a directory are
+# contiguous, sorted by name, and can be binary searched by Twalk.
+
+MAGIC = b"PEA9IMG1"
+HEADER = "<8sII"
+HEADER_SIZE = 16
+# type, parent, first_child, child_count, name_offset, name_length,
+# stat_length, stat_offset, data_offset, data_length
+ENTRY = "<B3xIIIIHHIII"
+ENTRY_SIZE = 36
+
+
+class ImageBuilder(Marshalling):
+    def __init__(self, uid="default", gid="default"):
+        self.uid = uid
+        self.gid = gid
+        self.root = self.node("/", True, None, 0)
+
+    def node(self, name, is_dir, data, mtime):
+        return {"name": name, "dir": is_dir, "data": data, "mtime": mtime, "children": {}}
+
+    def add(self, path, data=None, mtime=0):
+        # data None adds a directory, missing parents are created on the way
+        parent = self.root
+        names = [name for name in path.split("/") if name]
+        for name in names[:-1]:
+            if name not in parent["children"]:
+                parent["children"][name] = self.node(name, True, None, mtime)
+            parent = parent["children"][name]
+            if not parent["dir"]:
+                self.fatal("ImageBuilder: %s is a file." % name)
+        if len(names) > 0:
+            parent["children"][names[-1]] = self.node(names[-1], data is None, data, mtime)
+
+    def add_tree(self, source, prefix=""):
+        for entry in sorted(os.listdir(source)):
+            path = os.path.join(source, entry)
+            name = prefix + "/" + entry
+            mtime = int(os.stat(path).st_mtime)
+            if os.path.isdir(path):
+                self.add(name, None, mtime)
+                self.add_tree(path, name)
+            else:
+                with open(path, "rb") as f:
+                    self.add(name, f.read(), mtime)
+
+    def layout(self):
+        # breadth first, children sorted by their encoded name
+        order = [(self.root, 0)]
+        first_child = []
+        i = 0
+        while i < len(order):
+            node = order[i][0]
+            first_child.append(len(order))
+            children = sorted(node["children"].values(), key=lambda n: n["name"].encode("utf-8"))
+            for child in children:
+                order.append((child, i))
+            i += 1
+        return order, first_child
+
+    def save(self, filename):
+        order, first_child = self.layout()
+        names = bytearray()
+        stats = bytearray()
+        data = bytearray()
+        records = []
+        for index in range(len(order)):
+            node, parent = order[index]
+            name = node["name"].encode("utf-8")
+            if node["dir"]:
+                qid = Qid(Qid.QTDIR, 0, index)
+                mode = Stat.DIR | 0o555
+                length = 0
+            else:
+                qid = Qid(Qid.QTFILE, 0, index)
+                mode = 0o444
+                length = len(node["data"])
+            stat = Stat(node["name"], qid, length, mode, mtime=node["mtime"], atime=node["mtime"],
+                        uid=self.uid, gid=self.gid, muid=self.uid).serialize()
+            records.append((qid.type, parent, first_child[index], len(node["children"]),
+                            len(names), len(name), len(stat), len(stats), len(data), length))
+            names += name
+            stats += stat
+            if not node["dir"]:
+                data += node["data"]
+        names_offset = HEADER_SIZE + ENTRY_SIZE * len(records)
+        stats_offset = names_offset + len(names)
+        data_offset = stats_offset + len(stats)
+        with open(filename, "wb") as f:
+            f.write(struct.pack(HEADER, MAGIC, len(records), 0))
+            for r in records:
+                f.write(struct.pack(ENTRY, r[0], r[1], r[2], r[3], names_offset + r[4], r[5],
+                                    r[6], stats_offset + r[7], data_offset + r[8], r[9]))
+            f.write(names)
+            f.write(stats)
+            f.write(data)
+
+
+class MappedImage:
+    # cpython: the whole image is mmapped, slices are views into it
+    def __init__(self, filename):
+        import mmap
+        self.file = open(filename, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.image = memoryview(self.map)
+
+    def view(self, offset, size):
+        return self.image[offset:offset + size]
+
+    def close(self):
+        self.image.release()
+        self.map.close()
+        self.file.close()
+
+
+class FileImage:
+    # micropython: read what is asked for straight from flash
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+
+    def view(self, offset, size):
+        data = bytearray(size)
+        self.file.seek(offset)
+        self.file.readinto(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class PackedStat(Marshalling):
+    # A stat record straight out of the image, only ever re-sent as is.
+    def __init__(self, record):
+        self.record = record
+        self.qid = self.parse_qid(record, 8)
+
+    def size(self) -> int:
+        return len(self.record)
+
+    def serialize(self):
+        return self.record
+
+    def serialize_into(self, buf, ptr) -> int:
+        return self.pack_bytes(buf, ptr, self.record)
+
+    def to_stat(self) -> Stat:
+        return self.parse_stat(self.record, 0)[1]
+
+
+class PackedImageDriver(FileSystemDriver):
+    def __init__(self, filename, io_size=4096):
+        self._io_size = io_size
+        try:
+            self.image = MappedImage(filename)
+        except ImportError:
+            self.image = FileImage(filename)
+        magic, self.count, _ = struct.unpack_from(HEADER, self.image.view(0, HEADER_SIZE))
+        if magic != MAGIC:
+            self.fatal("PackedImageDriver: %s is not an image." % filename)
+
+    def close(self):
+        self.image.close()
+
+    def entry(self, index):
+        if index >= self.count:
+            self.fatal("PackedImageDriver: no entry %d." % index)
+        return struct.unpack_from(ENTRY, self.image.view(HEADER_SIZE + index * ENTRY_SIZE, ENTRY_SIZE))
+
+    def name(self, entry) -> bytes:
+        return bytes(self.image.view(entry[4], entry[5]))
+
+    def qid(self, index, entry) -> Qid:
+        return Qid(entry[0], 0, index)
+
+    def lookup(self, index, name):
+        # binary search the children of a directory, returns an entry index
+        entry = self.entry(index)
+        if entry[0] != Qid.QTDIR:
+            return None
+        key = name.encode("utf-8")
+        lo = entry[2]
+        hi = entry[2] + entry[3]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = self.name(self.entry(mid))
+            if found == key:
+                return mid
+            if found < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def io_size(self) -> int:
+        return self._io_size
+
+    def reset(self):
+        pass  # nothing to rebuild, the image never changes
+
+    def get_root(self, name="") -> Qid:
+        return self.qid(0, self.entry(0))
+
+    def has_entry(self, qid: Qid, name: str) -> bool:
+        return self.lookup(qid.path, name) is not None
+
+    def get_qid(self, qid: Qid, name: str) -> Qid:
+        index = self.lookup(qid.path, name)
+        if index is None:
+            return None
+        return self.qid(index, self.entry(index))
+
+    def walk_path(self, qid: Qid, names) -> list:
+        qids = []
+        index = qid.path
+        for name in names:
+            index = self.lookup(index, name)
+            if index is None:
+                break
+            qids.append(self.qid(index, self.entry(index)))
+        return qids
+
+    def get_stat(self, qid: Qid) -> PackedStat:
+        entry = self.entry(qid.path)
+        return PackedStat(self.image.view(entry[7], entry[6]))
+
+    def get_version(self, qid: Qid) -> int:
+        return 0
+
+    def open_file(self, qid: Qid, mode: int):
+        if (mode & 3) in (1, 2) or (mode & 0x10):  # OWRITE, ORDWR, OTRUNC
+            self.refuse(Protocol.E_READ_ONLY)
+        qid.private_data = 0
+
+    def close_file(self, qid: Qid):
+        qid.private_data = None
+
+    def list_dir(self, qid: Qid, index: int):
+        entry = self.entry(qid.path)
+        for child in range(entry[2] + index, entry[2] + entry[3]):
+            child_entry = self.entry(child)
+            yield PackedStat(self.image.view(child_entry[7], child_entry[6]))
+
+    def read_file(self, qid: Qid, offset: int, count: int):
+        entry = self.entry(qid.path)
+        if offset >= entry[9]:
+            return bytearray()
+        if offset + count > entry[9]:
+            count = entry[9] - offset
+        # a view of the mapped image, nothing is copied until it is sent
+        return self.image.view(entry[8] + offset, count)
+
+    def write_file(self, qid: Qid, offset: int, data: bytes) -> int:
+        self.refuse(Protocol.E_READ_ONLY)
+
+    def write_stat(self, qid: Qid, stat: Stat):
+        self.refuse(Protocol.E_READ_ONLY)
@@ -0,0 +1,315 @@
+import sys
+import time
+
+try:
+    from _thread import allocate_lock
+except ImportError:
+    allocate_lock = None
+
+from .base import Util, FileSystemDriver
+from .protocol import Protocol
+
+# A profiler that can be switched on in a running server, cpython only.
+#
+# While off nothing is instrumented. start() wraps Protocol.dispatch and
+# Protocol.reply, to time every request from the T-message to its reply,
+# and the methods of every FileSystemDriver class, to time the backend.
+# stop() puts the originals back and writes
+#
+#   path.txt        time per verb and per driver method
+#   path.pstats     mode "pstats": cProfile of the handlers and driver
+#                   calls, in whichever thread they ran. From cpython 3.12
+#                   on profiling is process wide, so it is one cProfile of
+#                   everything the process ran meanwhile.
+#   path.collapsed  mode "collapsed": sampled stacks of every thread, one
+#                   "frame;frame;frame count" line per stack, for flame graphs
+#
+# A run ends after seconds, after messages requests, or on stop().
+#
+# Clients may start runs through command(), but only pick a name for the
+# output within directory, which is up to whoever runs the server.
+
+DRIVER_METHODS = ("get_root", "has_entry", "get_qid", "walk_path", "get_stat", "get_version",
+                  "open_file", "close_file", "list_dir", "read_file", "write_file",
+                  "create_file", "remove", "write_stat")
+MODES = ("pstats", "collapsed")
+
+
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, spent):
+        self.count += 1
+        self.total += spent
+        if spent > self.max:
+            self.max = spent
+
+
+class Profiler(Util):
+    SAMPLE_INTERVAL = 0.001
+
+    def __init__(self, directory="/tmp"):
+        self.directory = directory
+        self.running = False
+        self.last = "never run"
+        self.shared = None  # the one cProfile from 3.12 on, see call()
+        self.patched = []  # (owner, name, original)
+        self.lock = allocate_lock() if allocate_lock is not None else None
+
+    def status(self) -> str:
+        if self.running:
+            return "running %s for %s seconds or %s messages, %d so far, into %s\n" % (
+                self.mode, self.seconds, self.messages, self.dispatched, self.path)
+        return "stopped, %s\n" % self.last
+
+    def start(self, seconds=None, messages=None, path=None, mode="pstats"):
+        if sys.implementation.name == "micropython":
+            self.refuse("Profiling needs cpython.")
+        if path is None:
+            path = self.directory + "/peanein-profile"
+        if mode not in MODES:
+            self.refuse("Profiler: unknown mode %s." % mode)
+        import threading
+        if self.running:
+            self.stop()
+        self.shared = None
+        if mode == "pstats" and sys.version_info >= (3, 12):
+            import cProfile
+            shared = cProfile.Profile()
+            try:
+                shared.enable()
+            except ValueError:
+                self.refuse("Profiler: another profiler is active.")
+            self.shared = shared
+        self.seconds = seconds
+        self.messages = messages
+        self.path = path
+        self.mode = mode
+        self.verbs = {}  # verb name -> Timing
+        self.calls = {}  # Class.method -> Timing
+        self.started = {}  # (server, tag) -> (verb name, start)
+        self.dispatched = 0
+        self.local = threading.local()
+        self.profiles = []  # one cProfile per thread that ran a handler
+        if self.shared is not None:
+            self.profiles.append(self.shared)
+        self.stacks = {}
+        self.began = time.perf_counter()
+        self.running = True
+        if mode == "collapsed":
+            self.sampler = threading.Thread(target=self.sample, daemon=True)
+            self.sampler.start()
+        self.timer = None
+        if seconds is not None:
+            self.timer = threading.Timer(seconds, self.stop)
+            self.timer.daemon = True
+            self.timer.start()
+        self.install()
+
+    def stop(self) -> str:
+        if self.lock is None:
+            return self.last
+        with self.lock:
+            if not self.running:
+                return self.last
+            self.running = False
+        self.uninstall()
+        if self.shared is not None:
+            self.shared.disable()
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.mode == "collapsed":
+            self.sampler.join()
+        self.last = self.dump(time.perf_counter() - self.began)
+        return self.last
+
+    # instrumentation, only in place while running
+
+    def install(self):
+        profiler = self
+        dispatch = Protocol.dispatch
+        reply = Protocol.reply
+
+        def profiled_dispatch(server, verb, tag, data):
+            profiler.request(server, verb, tag)
+            return profiler.call(dispatch, server, verb, tag, data)
+
+        def profiled_reply(server, verb, tag, end):
+            profiler.replied(server, tag)
+            return reply(server, verb, tag, end)
+
+        self.patch(Protocol, "dispatch", profiled_dispatch)
+        self.patch(Protocol, "reply", profiled_reply)
+        for cls in self.driver_classes(FileSystemDriver):
+            for name in DRIVER_METHODS:
+                if name in cls.__dict__:
+                    self.patch(cls, name, self.timed(cls.__dict__[name], cls.__name__ + "." + name))
+
+    def uninstall(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+
+    def patch(self, owner, name, method):
+        self.patched.append((owner, name, owner.__dict__[name]))
+        setattr(owner, name, method)
+
+    def driver_classes(self, cls) -> list:
+        out = []
+        for sub in cls.__subclasses__():
+            out.append(sub)
+            out += self.driver_classes(sub)
+        return out
+
+    def timed(self, method, label):
+        profiler = self
+
+        def timed_method(*args):
+            start = time.perf_counter()
+            try:
+                return profiler.call(method, *args)
+            finally:
+                profiler.record(profiler.calls, label, time.perf_counter() - start)
+        return timed_method
+
+    def call(self, method, *args):
+        # before 3.12 cProfile only sees the thread that enabled it, so every
+        # thread gets its own, run around the outermost instrumented call
+        if self.mode != "pstats" or self.shared is not None or getattr(self.local, "busy", False):
+            return method(*args)
+        profile = getattr(self.local, "profile", None)
+        if profile is None:
+            import cProfile
+            profile = cProfile.Profile()
+            self.local.profile = profile
+            with self.lock:
+                self.profiles.append(profile)
+        try:
+            profile.enable()
+        except Exception:
+            # the request runs whatever keeps the profile from running
+            return method(*args)
+        self.local.busy = True
+        try:
+            return method(*args)
+        finally:
+            profile.disable()
+            self.local.busy = False
+
+    def request(self, server, verb, tag):
+        with self.lock:
+            self.started[(id(server), tag)] = (server.verb_to_text(verb), time.perf_counter())
+            self.dispatched += 1
+            done = self.messages is not None and self.dispatched >= self.messages
+        if done:
+            self.stop_later()
+
+    def stop_later(self):
+        # finish outside of the request that got us there
+        import threading
+        threading.Thread(target=self.stop, daemon=True).start()
+
+    def replied(self, server, tag):
+        with self.lock:
+            started = self.started.pop((id(server), tag), None)
+        if started is not None:
+            self.record(self.verbs, started[0], time.perf_counter() - started[1])
+
+    def record(self, table, label, spent):
+        with self.lock:
+            timing = table.get(label)
+            if timing is None:
+                timing = Timing()
+                table[label] = timing
+            timing.add(spent)
+
+    def sample(self):
+        import threading
+        me = threading.get_ident()
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append("%s (%s:%d)" % (code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                stack = ";".join(reversed(names))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            time.sleep(self.SAMPLE_INTERVAL)
+
+    # results
+
+    def dump(self, elapsed) -> str:
+        # calls still in flight may record as we go
+        with self.lock:
+            verbs = dict(self.verbs)
+            calls = dict(self.calls)
+        lines = ["%.3f seconds, %d requests" % (elapsed, self.dispatched), ""]
+        lines += self.table("verb", verbs)
+        lines.append("")
+        lines += self.table("driver method", calls)
+        with open(self.path + ".txt", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        written = [self.path + ".txt"]
+        # a profile that never ran has nothing for pstats
+        profiles = [profile for profile in self.profiles if len(profile.getstats()) > 0]
+        if self.mode == "pstats" and len(profiles) > 0:
+            import pstats
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(self.path + ".pstats")
+            written.append(self.path + ".pstats")
+        if self.mode == "collapsed":
+            with open(self.path + ".collapsed", "w") as f:
+                for stack, count in self.stacks.items():
+                    f.write("%s %d\n" % (stack, count))
+            written.append(self.path + ".collapsed")
+        return "%d requests in %.3f seconds, wrote %s" % (self.dispatched, elapsed, " ".join(written))
+
+    def table(self, title, timings) -> list:
+        lines = ["%-28s %8s %12s %12s %12s" % (title, "count", "total ms", "mean us", "max us")]
+        order = sorted(timings.items(), key=lambda item: -item[1].total)
+        for label, t in order:
+            lines.append("%-28s %8d %12.3f %12.1f %12.1f" % (
+                label, t.count, t.total * 1e3, t.total / t.count * 1e6, t.max * 1e6))
+        return lines
+
+    def command(self, text):
+        # "start [seconds=N] [messages=N] [name=N] [mode=pstats|collapsed]" or "stop",
+        # the output goes to directory/name
+        words = text.split()
+        if len(words) == 0:
+            self.refuse("Profiler: empty command.")
+        if words[0] == "stop":
+            self.stop()
+        elif words[0] == "start":
+            options = {}
+            for word in words[1:]:
+                if "=" not in word:
+                    self.refuse("Profiler: bad option %s." % word)
+                key, value = word.split("=", 1)
+                if key in ("seconds", "messages"):
+                    try:
+                        value = float(value) if key == "seconds" else int(value)
+                    except ValueError:
+                        self.refuse(Protocol.E_BAD_ARGUMENT)
+                elif key == "name":
+                    if len(value) == 0 or "/" in value or value.startswith("."):
+                        self.refuse(Protocol.E_BAD_NAME)
+                    key, value = "path", self.directory + "/" + value
+                elif key != "mode":
+                    self.refuse("Profiler: unknown option %s." % key)
+                options[key] = value
+            self.start(**options)
+        else:
+            self.refuse("Profiler: unknown command %s." % words[0])
+
+
+# one per process, the instrumentation is process wide anyway
+profiler = Profiler()
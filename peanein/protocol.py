@@ -34,11 +34,31 @@ class Protocol(Marshalling):
     Topenfd = 98
     Ropenfd = 99
 
-    def __init__(self, channel, max_size=8192):
+    VERSION = "9P2000"
+    VERSION_Z = "9P2000.z"  # 9P2000 with compressed payloads
+    PAYLOAD_RAW = 0
+    PAYLOAD_DEFLATE = 1
+    PAYLOAD_MIN = 64  # not worth compressing anything smaller
+
+    def __init__(self, channel, max_size=8192, codec=None, static_buffers=False):
         self._channel = channel
         self._max_size = max_size
         self._configured_size = max_size
+        self._codec = codec  # what we could offer
+        self.codec = None  # what was negotiated by Tversion
         self.is_server = True
+        # replies are always encoded into the one transmit buffer
+        self._tx = bytearray(max_size)
+        self._tx_view = memoryview(self._tx)
+        # static_buffers: messages are read with readinto() into the one
+        # receive buffer and parsed in place, so the protocol layer needs no
+        # buffer per message. What a driver returns from read_file is still
+        # allocated by the driver. The data handed to the handlers is only
+        # valid until the next message is read.
+        self._rx = None
+        if static_buffers:
+            self._rx = bytearray(max_size)
+            self._rx_view = memoryview(self._rx)
 
     def verb_to_text(self, verb) -> str:
         verbs = ['Topenfd', 'Ropenfd', 'Tversion', 'Rversion',
@@ -63,18 +83,65 @@ class Protocol(Marshalling):
             self.fatal("NeinP.read: len(data) %d != count: %d." % (len(data), count))
         return data
 
+    def read_into(self, view):
+        got = 0
+        while got < len(view):
+            count = self._channel.readinto(view[got:])
+            if not count:
+                self.fatal("NeinP.read_into: got %d of %d." % (got, len(view)))
+            got += count
+
     def write(self, data):
         self._channel.write(data)
 
+    # Replies are built in place: reply_buffer() returns the transmit buffer
+    # and where the payload starts, reply() fills in the header and sends the
+    # message up to end.
+    def reply_buffer(self):
+        return self._tx, 7
+
+    def reply(self, verb, tag, end):
+        self.pack_uint(self._tx, 0, end, 4)
+        self.pack_uint(self._tx, 4, verb, 1)
+        self.pack_uint(self._tx, 5, tag, 2)
+        self.write(self._tx_view[:end])
+
     def send(self, verb, tag, data=None):
-        msg = self.serialize_uint(verb, 1)
-        msg += self.serialize_uint(tag, 2)
+        tx, ptr = self.reply_buffer()
         if not (data is None):
-            msg += data
-        size = len(msg) + 4
-        self.write(self.serialize_uint(size, 4) + msg)
+            ptr = self.pack_bytes(tx, ptr, data)
+        self.reply(verb, tag, ptr)
+
+    # In 9P2000.z the data of Rread and Twrite, and the stat of Rstat, are
+    # prefixed with one byte saying whether the rest is deflated or not.
+    # Deflated means raw deflate with a 512 byte window (see codec.WBITS),
+    # and it may not inflate past msize. An empty payload stays empty.
+    def pack_payload(self, data):
+        if self.codec is None or len(data) == 0:
+            return data
+        if len(data) >= self.PAYLOAD_MIN:
+            packed = self.codec.compress(data)
+            if len(packed) < len(data):
+                return bytearray([self.PAYLOAD_DEFLATE]) + packed
+        return bytearray([self.PAYLOAD_RAW]) + data
+
+    def unpack_payload(self, data):
+        if self.codec is None or len(data) == 0:
+            return data
+        if data[0] == self.PAYLOAD_DEFLATE:
+            return self.codec.decompress(data[1:], self._max_size)
+        elif data[0] != self.PAYLOAD_RAW:
+            self.fatal("unpack_payload: unknown payload type %d." % data[0])
+        return data[1:]
 
     def next(self):
+        verb, tag, data = self.receive()
+        self.dispatch(verb, tag, data)
+        return None
+
+    def receive(self):
+        if self._rx is not None:
+            return self.receive_static()
         size = self.parse_uint(self.read(4), 0, 4)
         verb = self.parse_uint(self.read(1), 0, 1)
         tag = self.parse_uint(self.read(2), 0, 2)
@@ -82,7 +149,21 @@ class Protocol(Marshalling):
             self.fatal("Packet is oversized.")
         # read rest of packet
         data = self.read(size - 7)
+        return verb, tag, data
+
+    def receive_static(self):
+        rx = self._rx_view
+        self.read_into(rx[0:7])
+        size = self.parse_uint(rx, 0, 4)
+        verb = self.parse_uint(rx, 4, 1)
+        tag = self.parse_uint(rx, 5, 2)
+        if (size + 4) > self._max_size or size < 7:
+            self.fatal("Packet is oversized.")
+        # read rest of packet
+        self.read_into(rx[7:size])
+        return verb, tag, rx[7:size]
 
+    def dispatch(self, verb, tag, data):
         name = self.verb_to_text(verb)
 
         is_client_message = (verb % 2) == 1
@@ -213,7 +294,7 @@ class Protocol(Marshalling):
         #       size[4] Rread tag[2] count[4] data[count]
         elif verb == self.Rread:
             count = self.parse_uint(data, 0, 4)
-            buffer = data[4:4 + count]
+            buffer = self.unpack_payload(data[4:4 + count])
             self.ClientRead(tag, buffer)
 
         ##################################################### WRITE
@@ -223,7 +304,7 @@ class Protocol(Marshalling):
             fid = self.parse_uint(data, 0, 4)
             offset = self.parse_uint(data, 4, 8)
             count = self.parse_uint(data, 12, 4)
-            buffer = data[16:16 + count]
+            buffer = self.unpack_payload(data[16:16 + count])
             self.ServerWrite(tag, fid, offset, buffer)
 
         #       size[4] Rwrite tag[2] count[4]
@@ -259,14 +340,15 @@ class Protocol(Marshalling):
 
         #       size[4] Rstat tag[2] stat[n]
         elif verb == self.Rstat:
-            size, stat = self.parse_stat(data, 0)
+            size, stat = self.parse_stat(self.unpack_payload(data[2:]), 0)
             self.ClientStat(tag, stat)
 
         ##################################################### WSTAT
         #       size[4] Twstat tag[2] fid[4] stat[n]
+        # stat[n] is preceded by its own count[2], as in Rstat
         elif verb == self.Twstat:
             fid = self.parse_uint(data, 0, 4)
-            size, stat = self.parse_stat(data, 4)
+            size, stat = self.parse_stat(data, 6)
             self.ServerWriteStat(tag, fid, stat)
 
         #       size[4] Rwstat tag[2]
@@ -302,8 +384,9 @@ class Protocol(Marshalling):
 
     def Error(self, tag, ename, fatal=False):
         #    ("Other end reports: '%s' #%d" % (ename, tag))
-        data = self.str_to_pas(ename)
-        self.send(self.Rerror, tag, data)
+        tx, ptr = self.reply_buffer()
+        ptr = self.pack_string(tx, ptr, ename)
+        self.reply(self.Rerror, tag, ptr)
 
         if fatal:
             self.fatal(ename)
@@ -382,6 +465,13 @@ class Protocol(Marshalling):
 
     NOFID = 0xffffffff
     NOTAG = 0xffff
+    # open and create modes
+    OREAD = 0
+    OWRITE = 1
+    ORDWR = 2
+    OEXEC = 3
+    OTRUNC = 0x10
+    ORCLOSE = 0x40
     E_NEED_NOTAG = "NOTAG(0xFFFF) Required for Tversion."
     E_9P2000_ONLY = "We only talk 9P2000 Here."
     E_NO_AUTH = "No authentication required."
@@ -393,3 +483,14 @@ class Protocol(Marshalling):
     E_ALREADY_OPEN = "File already open."
     E_NOT_FOUND = "Not found."
     E_NOT_OPEN = "File not opened."
+    E_NOT_OPEN_WRITE = "File not opened for writing."
+    E_BAD_OFFSET = "Bad directory read offset."
+    E_COUNT_TOO_SMALL = "Read count too small."
+    E_TOO_MANY_WAITING = "Too many reads waiting."
+    E_BAD_ARGUMENT = "Bad argument."
+    E_EXISTS = "File exists."
+    E_NOT_EMPTY = "Directory not empty."
+    E_IS_DIR = "Is a directory."
+    E_BAD_NAME = "Bad file name."
+    E_NO_SPACE = "No space left."
+    E_READ_ONLY = "Read only file system."
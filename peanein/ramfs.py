@@ -0,0 +1,342 @@
+import time
+
+try:
+    from _thread import allocate_lock
+except ImportError:
+    allocate_lock = None
+
+from .base import DriverError, FileSystemDriver, Qid, Stat
+from .protocol import Protocol
+
+# A tmpfs style read/write tree kept in memory, for scratch space and caches.
+#
+# File data lives in fixed size chunks keyed by chunk number, so a write only
+# touches the chunks it covers: appends and random writes never copy the rest
+# of the file, and holes in a sparse file take no memory and read as zeros.
+# Only chunk memory is accounted against the capacity, names and metadata
+# are not.
+
+KEEP32 = 0xffffffff  # Twstat: leave this field alone
+KEEP64 = 0xffffffffffffffff
+
+
+class Extents:
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.chunks = {}  # chunk number -> bytearray(chunk_size)
+        self.length = 0
+
+    def allocated(self) -> int:
+        return len(self.chunks) * self.chunk_size
+
+    def missing(self, offset, count) -> int:
+        # bytes of chunks a write of count bytes at offset would allocate
+        if count == 0:
+            return 0
+        needed = 0
+        for number in range(offset // self.chunk_size, (offset + count - 1) // self.chunk_size + 1):
+            if number not in self.chunks:
+                needed += self.chunk_size
+        return needed
+
+    def read(self, offset, count) -> bytearray:
+        if offset >= self.length:
+            return bytearray()
+        if offset + count > self.length:
+            count = self.length - offset
+        # a copy: the chunks may be written again before the reply is sent
+        data = bytearray(count)
+        done = 0
+        while done < count:
+            number, start = divmod(offset + done, self.chunk_size)
+            size = min(self.chunk_size - start, count - done)
+            chunk = self.chunks.get(number)
+            if chunk is not None:
+                data[done:done + size] = chunk[start:start + size]
+            done += size
+        return data
+
+    def write(self, offset, data) -> int:
+        view = memoryview(data)
+        done = 0
+        while done < len(view):
+            number, start = divmod(offset + done, self.chunk_size)
+            size = min(self.chunk_size - start, len(view) - done)
+            chunk = self.chunks.get(number)
+            if chunk is None:
+                chunk = bytearray(self.chunk_size)
+                self.chunks[number] = chunk
+            chunk[start:start + size] = view[done:done + size]
+            done += size
+        if offset + done > self.length:
+            self.length = offset + done
+        return done
+
+    def truncate(self, length):
+        # growing leaves a hole, shrinking frees the chunks past the end and
+        # zeroes the tail of the last one so a later grow reads zeros
+        if length < self.length:
+            last = (length + self.chunk_size - 1) // self.chunk_size
+            for number in list(self.chunks.keys()):
+                if number >= last:
+                    del self.chunks[number]
+            start = length % self.chunk_size
+            chunk = self.chunks.get(length // self.chunk_size)
+            if chunk is not None and start > 0:
+                chunk[start:] = bytearray(self.chunk_size - start)
+        self.length = length
+
+
+class Node:
+    def __init__(self, name, qid, mode, parent, uid, now):
+        self.name = name
+        self.qid = qid
+        self.mode = mode
+        self.parent = parent
+        self.uid = uid
+        self.gid = uid
+        self.muid = uid
+        self.atime = now
+        self.mtime = now
+        if qid.is_dir():
+            self.children = {}
+            self.data = None
+        else:
+            self.children = None
+            self.data = None  # Extents, set by the driver
+
+    def length(self) -> int:
+        if self.data is None:
+            return 0
+        return self.data.length
+
+    def stat(self) -> Stat:
+        return Stat(self.name, self.qid, self.length(), self.mode, atime=self.atime, mtime=self.mtime,
+                    uid=self.uid, gid=self.gid, muid=self.muid)
+
+
+class RamFS(FileSystemDriver):
+    # capacity: bytes of file data it may hold, None for no limit
+    def __init__(self, capacity=None, chunk_size=4096, io_size=4096, uid="default"):
+        self.capacity = capacity
+        self.chunk_size = chunk_size
+        self._io_size = io_size
+        self.uid = uid
+        # requests may come from several executor threads at once
+        self.lock = allocate_lock() if allocate_lock is not None else None
+        self.reset()
+
+    def io_size(self) -> int:
+        return self._io_size
+
+    def reset(self):
+        self.used = 0  # bytes of chunks allocated
+        self.next_path = 1
+        self.root = Node("/", Qid(Qid.QTDIR, 0, 0), Stat.DIR | 0o777, None, self.uid, self.now())
+        self.nodes = {0: self.root}  # qid path -> Node
+
+    def now(self) -> int:
+        return int(time.time())
+
+    def acquire(self):
+        if self.lock is not None:
+            self.lock.acquire()
+
+    def release(self):
+        if self.lock is not None:
+            self.lock.release()
+
+    def node(self, qid: Qid) -> Node:
+        node = self.nodes.get(qid.path)
+        if node is None:
+            # removed while a fid still pointed at it
+            self.refuse(Protocol.E_NOT_FOUND)
+        return node
+
+    def get_root(self, name="") -> Qid:
+        return self.root.qid
+
+    def has_entry(self, qid: Qid, name: str) -> bool:
+        return self.get_qid(qid, name) is not None
+
+    def get_qid(self, qid: Qid, name: str) -> Qid:
+        node = self.nodes.get(qid.path)
+        if node is None or node.children is None:
+            return None
+        if name == "..":
+            return (node.parent or node).qid
+        child = node.children.get(name)
+        if child is None:
+            return None
+        return child.qid
+
+    def walk_path(self, qid: Qid, names) -> list:
+        qids = []
+        for name in names:
+            qid = self.get_qid(qid, name)
+            if qid is None:
+                break
+            qids.append(qid)
+        return qids
+
+    def get_stat(self, qid: Qid) -> Stat:
+        return self.node(qid).stat()
+
+    def get_version(self, qid: Qid) -> int:
+        return self.node(qid).qid.version
+
+    def open_file(self, qid: Qid, mode: int):
+        self.acquire()
+        try:
+            node = self.node(qid)
+            if node.children is not None and ((mode & 3) in (Protocol.OWRITE, Protocol.ORDWR) or mode & Protocol.OTRUNC):
+                self.refuse(Protocol.E_IS_DIR)
+            if mode & Protocol.OTRUNC:
+                self.resize(node, 0)
+            node.atime = self.now()
+        finally:
+            self.release()
+        qid.private_data = mode
+
+    def close_file(self, qid: Qid):
+        mode = qid.private_data
+        qid.private_data = None
+        # skipped when a Tremove got there first
+        if mode is not None and mode & Protocol.ORCLOSE and qid.path in self.nodes:
+            try:
+                self.remove(qid)
+            except DriverError:
+                pass  # a clunk can't fail, whatever stopped the remove wins
+
+    def list_dir(self, qid: Qid, index: int):
+        # a snapshot, creates and removes show up on the next read from 0
+        for child in list(self.node(qid).children.values())[index:]:
+            yield child.stat()
+
+    def read_file(self, qid: Qid, offset: int, count: int) -> bytearray:
+        self.acquire()
+        try:
+            return self.node(qid).data.read(offset, count)
+        finally:
+            self.release()
+
+    def write_file(self, qid: Qid, offset: int, data: bytes) -> int:
+        self.acquire()
+        try:
+            # looked up under the lock, a file removed meanwhile takes no space
+            node = self.node(qid)
+            if node.data is None:
+                self.refuse(Protocol.E_IS_DIR)
+            if qid.private_data is None or (qid.private_data & 3) not in (Protocol.OWRITE, Protocol.ORDWR):
+                self.refuse(Protocol.E_NOT_OPEN_WRITE)
+            if node.mode & Stat.APPEND:
+                offset = node.data.length
+            self.reserve(node.data.missing(offset, len(data)))
+            before = node.data.allocated()
+            count = node.data.write(offset, data)
+            self.used += node.data.allocated() - before
+            self.changed(node)
+        finally:
+            self.release()
+        return count
+
+    def create_file(self, qid: Qid, name: str, perm: int, mode: int) -> Qid:
+        if len(name) == 0 or name in (".", "..") or "/" in name:
+            self.refuse(Protocol.E_BAD_NAME)
+        # refused before anything is made, open_file would refuse it after
+        if perm & Stat.DIR and ((mode & 3) in (Protocol.OWRITE, Protocol.ORDWR) or mode & Protocol.OTRUNC):
+            self.refuse(Protocol.E_IS_DIR)
+        self.acquire()
+        try:
+            # under the lock, so the directory can't be removed meanwhile
+            parent = self.node(qid)
+            if parent.children is None:
+                self.refuse(Protocol.E_NOT_DIR)
+            if name in parent.children:
+                self.refuse(Protocol.E_EXISTS)
+            path = self.next_path
+            self.next_path += 1
+            # permissions are limited by those of the directory, as in Plan 9
+            if perm & Stat.DIR:
+                qid = Qid(Qid.QTDIR, 0, path)
+                perm = perm & (~0o777 | (parent.mode & 0o777))
+            else:
+                qid = Qid(Qid.QTAPPEND if perm & Stat.APPEND else Qid.QTFILE, 0, path)
+                perm = perm & (~0o666 | (parent.mode & 0o666))
+            node = Node(name, qid, perm & 0xffffffff, parent, self.uid, self.now())
+            if node.children is None:
+                node.data = Extents(self.chunk_size)
+            parent.children[name] = node
+            self.nodes[path] = node
+            self.changed(parent)
+        finally:
+            self.release()
+        return node.qid
+
+    def remove(self, qid: Qid):
+        self.acquire()
+        try:
+            node = self.node(qid)
+            if node is self.root:
+                self.refuse(Protocol.E_READ_ONLY)
+            if node.children is not None and len(node.children) > 0:
+                self.refuse(Protocol.E_NOT_EMPTY)
+            if node.data is not None:
+                self.used -= node.data.allocated()
+            del node.parent.children[node.name]
+            del self.nodes[node.qid.path]
+            self.changed(node.parent)
+        finally:
+            self.release()
+        # the fid goes with the file, close_file has nothing left to do
+        qid.private_data = None
+
+    def write_stat(self, qid: Qid, stat: Stat):
+        # all or nothing: everything is checked before anything changes,
+        # under the lock so no other request changes it in between
+        self.acquire()
+        try:
+            node = self.node(qid)
+            rename = len(stat.name) > 0 and stat.name != node.name
+            if rename:
+                if node is self.root or stat.name in (".", "..") or "/" in stat.name:
+                    self.refuse(Protocol.E_BAD_NAME)
+                if stat.name in node.parent.children:
+                    self.refuse(Protocol.E_EXISTS)
+            if stat.length != KEEP64 and node.children is not None and stat.length != 0:
+                self.refuse(Protocol.E_IS_DIR)
+            if stat.mode != KEEP32 and (stat.mode & Stat.DIR) != (node.mode & Stat.DIR):
+                self.refuse(Protocol.E_IS_DIR)
+            if rename:
+                del node.parent.children[node.name]
+                node.name = stat.name
+                node.parent.children[node.name] = node
+                self.changed(node.parent)
+            if stat.length != KEEP64 and node.data is not None:
+                self.resize(node, stat.length)
+            if stat.mode != KEEP32:
+                node.mode = stat.mode
+            if stat.mtime != KEEP32:
+                node.mtime = stat.mtime
+            if len(stat.gid) > 0:
+                node.gid = stat.gid
+            self.bump_version(node.qid)
+        finally:
+            self.release()
+
+    # the helpers below expect the lock to be held
+
+    def reserve(self, size):
+        if self.capacity is not None and self.used + size > self.capacity:
+            self.refuse(Protocol.E_NO_SPACE)
+
+    def resize(self, node, length):
+        before = node.data.allocated()
+        node.data.truncate(length)
+        self.used += node.data.allocated() - before
+        self.changed(node)
+
+    def changed(self, node):
+        node.mtime = self.now()
+        node.muid = self.uid
+        self.bump_version(node.qid)
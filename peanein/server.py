@@ -1,4 +1,4 @@
-from peanein.base import Qid, FileSystemDriver
+from peanein.base import Qid, FileSystemDriver, DirectoryCursor, TreeRegistry, DriverError
 from peanein.protocol import Protocol
 
 
@@ -6,12 +6,33 @@ class Server(Protocol):
     current_user = "default"
     fids = {}
 
-    def __init__(self, channel, filesystem_driver: FileSystemDriver, max_size=8192):
-        super().__init__(channel, max_size)
+    def __init__(self, channel, filesystem_driver: FileSystemDriver, max_size=8192, codec=None,
+                 static_buffers=False, trees: TreeRegistry = None):
+        super().__init__(channel, max_size, codec, static_buffers)
+        # filesystem_driver serves the empty aname, trees any others
         self.filesystem_driver = filesystem_driver
-
-    def add_fid(self, fid: int, qid: Qid):
+        self.trees = trees
+        self.fids = {}
+        self.fid_trees = {}
+        self.dir_cursors = {}
+        self.attached = []  # trees other than the default used this session
+
+    def get_tree(self, aname: str):
+        if len(aname) == 0:
+            return self.filesystem_driver
+        if self.trees is None:
+            return None
+        return self.trees.get(aname)
+
+    def add_fid(self, fid: int, qid: Qid, driver=None):
+        if driver is None:
+            driver = self.filesystem_driver
         self.fids[fid] = qid
+        self.fid_trees[fid] = driver
+
+    def driver_for(self, fid: int):
+        # the driver of the tree the fid was attached to
+        return self.fid_trees.get(fid, self.filesystem_driver)
 
     def get_fid(self, fid: int) -> Qid:
         if self.exists_fid(fid):
@@ -21,41 +42,66 @@ class Server(Protocol):
     def del_fid(self, fid: int):
         if self.exists_fid(fid):
             del self.fids[fid]
+            del self.fid_trees[fid]
+        if fid in self.dir_cursors:
+            del self.dir_cursors[fid]
 
     def init_fids(self):
         if self.fids is not None:
             for x in self.fids.keys():
                 qid = self.fids[x]
-                if qid.is_opened:
-                    self.filesystem_driver.close_file(qid)
+                if qid.is_opened():
+                    self.driver_for(x).close_file(qid)
         self.fids = {}
+        self.fid_trees = {}
+        self.dir_cursors = {}
 
     def exists_fid(self, fid: int) -> bool:
         return fid in self.fids
 
+    def dispatch(self, verb, tag, data):
+        # what a driver refuses is answered, the connection carries on
+        try:
+            super().dispatch(verb, tag, data)
+        except DriverError as e:
+            self.Error(tag, str(e))
+
     def ServerVersion(self, tag, msize, version):
-        # everything is cleared/reset on a Tversion
-        self._max_size = self._configured_size
+        # A Tversion starts a new session. Only this session's state is
+        # dropped, the drivers may well be shared with other connections.
         self.init_fids()
-        self.filesystem_driver.reset()
+        self.filesystem_driver.session_reset()
+        for driver in self.attached:
+            driver.session_reset()
+        self.attached = []
+        self.negotiate_version(tag, msize, version)
+
+    def negotiate_version(self, tag, msize, version):
+        self._max_size = self._configured_size
+        self.codec = None
 
         if tag != self.NOTAG:
             self.Error(tag, self.E_NEED_NOTAG)
 
-        if version != '9P2000':
+        # anything else 9P2000-ish is answered with plain 9P2000
+        if not version.startswith(self.VERSION):
             self.Error(tag, self.E_9P2000_ONLY, fatal=True)
 
         if msize < self._max_size:
             self._max_size = msize
 
-        self.ClientVersion(tag, self._max_size, '9P2000')
+        if version == self.VERSION_Z and self._codec is not None:
+            self.codec = self._codec
+            self.ClientVersion(tag, self._max_size, self.VERSION_Z)
+        else:
+            self.ClientVersion(tag, self._max_size, self.VERSION)
 
     def ClientVersion(self, tag, msize, version):
         # size[4]  Rversion  tag[2]  msize[4]  version[s]
-        data = self.serialize_uint(msize, 4)
-        text = self.str_to_pas(version)
-        data += text
-        self.send(self.Rversion, tag, data)
+        tx, ptr = self.reply_buffer()
+        ptr = self.pack_uint(tx, ptr, msize, 4)
+        ptr = self.pack_string(tx, ptr, version)
+        self.reply(self.Rversion, tag, ptr)
 
     def ServerAuth(self, tag, afid, uname, aname):
         # No auth here, reply with error
@@ -67,23 +113,29 @@ class Server(Protocol):
             return
         if uname is None or len(uname.strip()) == 0:
             uname = "unset"
-        # aname might be subtree.
+        # aname picks the tree
         if aname is None:
             aname = ""
-        if len(aname) != 0:
+        driver = self.get_tree(aname)
+        if driver is None:
             self.Error(tag, self.E_NO_ALT_ROOT)
         else:
-            qid = self.filesystem_driver.get_root()
-            self.add_fid(fid, qid)
+            qid = driver.get_root()
+            if driver is not self.filesystem_driver and driver not in self.attached:
+                self.attached.append(driver)
+            # every fid gets its own copy, which carries its open state
+            self.add_fid(fid, qid.duplicate(), driver)
             self.ClientAttach(tag, qid)
 
     def ClientAttach(self, tag, qid):
-        data = qid.serialize()
-        self.send(self.Rattach, tag, data)
+        tx, ptr = self.reply_buffer()
+        ptr = qid.serialize_into(tx, ptr)
+        self.reply(self.Rattach, tag, ptr)
 
     def ServerWalk(self, tag, fid, newfid, wname_array):
         # fetch the qid from the fid store
         qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
         # consistency check, does FID exist?
         if qid is None:
             self.Error(tag, self.E_INVALID_FID)
@@ -98,104 +150,205 @@ class Server(Protocol):
             return
         # shortcut, if there's no walking, just copy qid into newfid and have done with it
         if len(wname_array) == 0:
-            self.add_fid(newfid, qid.duplicate())
+            self.add_fid(newfid, qid.duplicate(), driver)
             self.ClientWalk(tag, [])
             return
         # The fid must represent a directory unless zero path name elements are specified.
         if not qid.is_dir():
             self.Error(tag, self.E_NOT_DIR)
             return
-        # now walk the fs tree
-        qid_array = []
-        for name in wname_array:
-            if self.filesystem_driver.has_entry(qid, name):
-                qid = self.filesystem_driver.get_qid(qid, name)
-                qid_array.append(qid)
+        # now walk the fs tree, in one go
+        qid_array = driver.walk_path(qid, wname_array)
+        # not even the first element was found
+        if len(qid_array) == 0:
+            self.Error(tag, self.E_NOT_FOUND)
+            return
         # if success
         if len(qid_array) == len(wname_array):
-            self.add_fid(newfid, qid)
+            self.add_fid(newfid, qid_array[-1].duplicate(), driver)
         self.ClientWalk(tag, qid_array)
 
     def ClientWalk(self, tag, wqid_array):
         # size[4] Rwalk tag[2] nwqid[2] nwqid*(qid[13])
-        data = self.serialize_uint(len(wqid_array), 2)
+        tx, ptr = self.reply_buffer()
+        ptr = self.pack_uint(tx, ptr, len(wqid_array), 2)
         for qid in wqid_array:
-            data += qid.serialize()
-        self.send(self.Rwalk, tag, data)
+            ptr = qid.serialize_into(tx, ptr)
+        self.reply(self.Rwalk, tag, ptr)
 
     def ServerClunk(self, tag, fid):
         if self.exists_fid(fid):
             qid = self.get_fid(fid)
+            driver = self.driver_for(fid)
             self.del_fid(fid)
             if qid.is_opened():
-                self.filesystem_driver.close_file(qid)
+                driver.close_file(qid)
         self.ClientClunk(tag)
 
     def ClientClunk(self, tag):
-        self.send(self.Rclunk, tag, None)
+        self.send(self.Rclunk, tag)
 
     def ServerStat(self, tag, fid):
         qid = self.get_fid(fid)
-        stat = self.filesystem_driver.get_stat(qid)
+        if qid is None:
+            self.Error(tag, self.E_INVALID_FID)
+            return
+        driver = self.driver_for(fid)
+        stat = driver.get_stat(qid)
         self.ClientStat(tag, stat)
 
     def ClientStat(self, tag, stat):
-        data = stat.serialize()
-
+        tx, ptr = self.reply_buffer()
         # Add extra length due to a bug in the actual implementations
-        size = len(data)
-        data = self.serialize_uint(size, 2) + data
-
-        self.send(self.Rstat, tag, data)
+        if self.codec is None:
+            end = stat.serialize_into(tx, ptr + 2)
+        else:
+            end = self.pack_bytes(tx, ptr + 2, self.pack_payload(stat.serialize()))
+        self.pack_uint(tx, ptr, end - ptr - 2, 2)
+        self.reply(self.Rstat, tag, end)
 
     def ServerOpen(self, tag, fid, mode):
         if not self.exists_fid(fid):
             self.Error(tag, self.E_INVALID_FID)
             return
         qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
+        if qid.is_opened():
+            self.Error(tag, self.E_ALREADY_OPEN)
+            return
+        self.open_fid(fid, qid, mode)
+        self.ClientOpen(tag, qid, driver.io_size())
+
+    def open_fid(self, fid, qid, mode):
+        driver = self.driver_for(fid)
+        driver.open_file(qid, mode)
+        # the fid's copy of the qid may predate changes since the walk
+        qid.version = driver.get_version(qid)
+        if qid.is_dir():
+            entries = driver.list_dir(qid, 0)
+            if entries is not None:
+                self.dir_cursors[fid] = DirectoryCursor(entries)
+
+    def ServerCreate(self, tag, fid, name, perm, mode):
+        if not self.exists_fid(fid):
+            self.Error(tag, self.E_INVALID_FID)
+            return
+        qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
         if qid.is_opened():
             self.Error(tag, self.E_ALREADY_OPEN)
             return
-        self.filesystem_driver.open_file(qid, mode)
-        self.ClientOpen(tag, qid, self.filesystem_driver.io_size())
+        if not qid.is_dir():
+            self.Error(tag, self.E_NOT_DIR)
+            return
+        # the fid moves from the directory to the new file once it is open
+        created = driver.create_file(qid, name, perm, mode).duplicate()
+        self.open_fid(fid, created, mode)
+        self.fids[fid] = created
+        self.ClientCreate(tag, created, driver.io_size())
+
+    def ClientCreate(self, tag, qid, iounit):
+        tx, ptr = self.reply_buffer()
+        ptr = qid.serialize_into(tx, ptr)
+        ptr = self.pack_uint(tx, ptr, iounit, 4)
+        self.reply(self.Rcreate, tag, ptr)
+
+    def ServerRemove(self, tag, fid):
+        # the fid is clunked whether or not the remove succeeds
+        if not self.exists_fid(fid):
+            self.Error(tag, self.E_INVALID_FID)
+            return
+        qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
+        self.del_fid(fid)
+        opened = qid.is_opened()
+        try:
+            driver.remove(qid)
+        finally:
+            # after the remove, so ORCLOSE finds nothing left to remove
+            if opened:
+                driver.close_file(qid)
+        self.ClientRemove(tag)
+
+    def ClientRemove(self, tag):
+        self.send(self.Rremove, tag)
 
     def ClientOpen(self, tag, qid, iounit):
-        data = qid.serialize()
-        data += self.serialize_uint(iounit, 4)
-        self.send(self.Ropen, tag, data)
+        tx, ptr = self.reply_buffer()
+        ptr = qid.serialize_into(tx, ptr)
+        ptr = self.pack_uint(tx, ptr, iounit, 4)
+        self.reply(self.Ropen, tag, ptr)
 
     def ServerRead(self, tag, fid, offset, count):
         if not self.exists_fid(fid):
             self.Error(tag, self.E_INVALID_FID)
             return
         qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
         if not qid.is_opened():
             self.Error(tag, self.E_NOT_OPEN)
             return
-        buffer = self.filesystem_driver.read_file(qid, offset, count)
+        wanted = count
+        count = self.clip_read(count)
+        if count == 0 and wanted > 0:
+            self.Error(tag, self.E_COUNT_TOO_SMALL)
+            return
+        cursor = self.dir_cursors.get(fid)
+        if cursor is None:
+            buffer = driver.read_file(qid, offset, count)
+        else:
+            # directories may only be read sequentially, or from the start again
+            if offset == 0 and cursor.offset != 0:
+                cursor = DirectoryCursor(driver.list_dir(qid, 0))
+                self.dir_cursors[fid] = cursor
+            elif offset != cursor.offset:
+                self.Error(tag, self.E_BAD_OFFSET)
+                return
+            buffer = cursor.read(count)
+            if buffer is None:
+                self.Error(tag, self.E_COUNT_TOO_SMALL)
+                return
         self.ClientRead(tag, buffer)
 
+    def clip_read(self, count):
+        # Rread must fit the transmit buffer: header, count, payload type
+        if count > self._max_size - 12:
+            return self._max_size - 12
+        # and in 9P2000.z the payload type byte is part of the count
+        if self.codec is not None and count > 0:
+            return count - 1
+        return count
+
     def ClientRead(self, tag, buffer):
-        length = len(buffer)
-        data = self.serialize_uint(length, 4) + buffer
-        self.send(self.Rread, tag, data)
+        buffer = self.pack_payload(buffer)
+        tx, ptr = self.reply_buffer()
+        ptr = self.pack_uint(tx, ptr, len(buffer), 4)
+        ptr = self.pack_bytes(tx, ptr, buffer)
+        self.reply(self.Rread, tag, ptr)
 
     def ServerWrite(self, tag, fid, offset, buffer):
         if not self.exists_fid(fid):
             self.Error(tag, self.E_INVALID_FID)
             return
         qid = self.get_fid(fid)
+        driver = self.driver_for(fid)
         if not qid.is_opened():
             self.Error(tag, self.E_NOT_OPEN)
             return
-        count = self.filesystem_driver.write_file(qid, offset, buffer)
+        count = driver.write_file(qid, offset, buffer)
         self.ClientWrite(tag, count)
 
     def ClientWrite(self, tag, count):
-        self.send(self.Rwrite, tag, self.serialize_uint(count, 4))
+        tx, ptr = self.reply_buffer()
+        ptr = self.pack_uint(tx, ptr, count, 4)
+        self.reply(self.Rwrite, tag, ptr)
 
     def ServerWriteStat(self, tag, fid, stat):
-        # no-op
+        qid = self.get_fid(fid)
+        if qid is None:
+            self.Error(tag, self.E_INVALID_FID)
+            return
+        self.driver_for(fid).write_stat(qid, stat)
         self.ClientWriteStat(tag)
 
     def ClientWriteStat(self, tag):
@@ -0,0 +1,279 @@
+import ctypes
+import mmap
+import os
+import platform
+
+from .base import Util
+
+# A transport between two processes on the same host: one shared mapping
+# holding a ring per direction. 9P frames are copied straight into and out
+# of the mapping, no socket in between.
+#
+#   path        the mapping: HEADER bytes of control words, then the
+#               client to server ring, then the server to client ring
+#
+# Each ring has a single writer and a single reader. head and tail only
+# ever grow, head - tail is what is waiting to be read. Every control word
+# is 8 aligned bytes on a cache line of its own and written in one store.
+#
+# A side with nothing to do sleeps in futex(2) on a bell word of the ring.
+# After publishing, the other side rings it (bumps the word and wakes the
+# futex) only when the sleeper said it waits. A round trip so costs at most
+# a wait and a wake per side, no more syscalls than over a socket, and none
+# while both sides keep busy.
+# Checking whether the peer sleeps right after publishing can still race
+# with it going to sleep (nothing here is a full memory barrier), so
+# sleepers also wake up every WAKE_TIMEOUT seconds to look again.
+#
+# cpython on Linux only: mmap, and futex through ctypes.
+
+MAGIC = 0x32474e5239414550  # b"PEA9RNG2"
+HEADER = 4096
+LINE = 8  # words per cache line
+
+# control words, in units of 8 bytes
+W_MAGIC = 0
+W_SIZE = 1
+W_CLOSED = (2, 3)  # server, client
+RINGS = (8, 56)  # client to server, server to client
+R_HEAD = 0
+R_TAIL = LINE
+R_READER_WAITS = 2 * LINE
+R_WRITER_WAITS = 3 * LINE
+R_READER_BELL = 4 * LINE
+R_WRITER_BELL = 5 * LINE
+
+# shared between processes, so not FUTEX_PRIVATE_FLAG
+FUTEX_WAIT = 0
+FUTEX_WAKE = 1
+SYS_FUTEX = {"x86_64": 202, "aarch64": 98, "armv7l": 240, "i686": 240, "riscv64": 98}.get(platform.machine())
+
+
+class Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+SERVER = 0
+CLIENT = 1
+
+
+class Ring:
+    def __init__(self, words, data, base):
+        self.words = words
+        self.data = data
+        self.size = len(data)
+        self.head = base + R_HEAD
+        self.tail = base + R_TAIL
+        self.reader_waits = base + R_READER_WAITS
+        self.writer_waits = base + R_WRITER_WAITS
+        self.reader_bell = base + R_READER_BELL
+        self.writer_bell = base + R_WRITER_BELL
+
+    def available(self) -> int:
+        return self.words[self.head] - self.words[self.tail]
+
+    def space(self) -> int:
+        return self.size - self.available()
+
+    def put(self, view) -> int:
+        # copy what fits, then publish it
+        head = self.words[self.head]
+        count = min(len(view), self.size - (head - self.words[self.tail]))
+        start = head % self.size
+        first = min(count, self.size - start)
+        self.data[start:start + first] = view[:first]
+        if count > first:
+            self.data[:count - first] = view[first:count]
+        self.words[self.head] = head + count
+        return count
+
+    def give(self, data) -> bool:
+        # all of data in one copy if it fits without wrapping
+        n = len(data)
+        head = self.words[self.head]
+        start = head % self.size
+        if self.size - (head - self.words[self.tail]) < n or start + n > self.size:
+            return False
+        self.data[start:start + n] = data
+        self.words[self.head] = head + n
+        return True
+
+    def take(self, n):
+        # n bytes in one copy if they are all in and don't wrap, else None
+        tail = self.words[self.tail]
+        start = tail % self.size
+        if self.words[self.head] - tail < n or start + n > self.size:
+            return None
+        data = bytes(self.data[start:start + n])
+        self.words[self.tail] = tail + n
+        return data
+
+    def get_into(self, view) -> int:
+        tail = self.words[self.tail]
+        count = min(len(view), self.words[self.head] - tail)
+        start = tail % self.size
+        first = min(count, self.size - start)
+        view[:first] = self.data[start:start + first]
+        if count > first:
+            view[first:count] = self.data[:count - first]
+        self.words[self.tail] = tail + count
+        return count
+
+
+class ShmRingEndpoint(Util):
+    # polls before going to sleep on the doorbell, on a single cpu polling
+    # only keeps the peer from running
+    SPIN = 200 if (os.cpu_count() or 1) > 1 else 0
+    WAKE_TIMEOUT = 0.005
+
+    def __init__(self, path, side, size=None):
+        if SYS_FUTEX is None:
+            self.fatal("ShmRing: no futex on %s." % platform.machine())
+        self.path = path
+        self.side = side
+        if side == SERVER:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.file = open(path, "w+b")
+            self.file.truncate(HEADER + 2 * size)
+        else:
+            self.file = open(path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        view = memoryview(self.map)
+        self.words = view[:HEADER].cast("Q")
+        if side == SERVER:
+            self.words[W_SIZE] = size
+            self.words[W_MAGIC] = MAGIC
+        elif self.words[W_MAGIC] != MAGIC:
+            self.fatal("ShmRing: %s is not a ring." % path)
+        size = self.words[W_SIZE]
+        self.size = size
+        to_server = Ring(self.words, view[HEADER:HEADER + size], RINGS[0])
+        to_client = Ring(self.words, view[HEADER + size:HEADER + 2 * size], RINGS[1])
+        # the mapping can't be closed while any of these are around
+        self.views = [view, self.words, to_server.data, to_client.data]
+        # futex wants addresses, the export only lives for the lookup
+        anchor = ctypes.c_char.from_buffer(self.map)
+        self.base = ctypes.addressof(anchor)
+        del anchor
+        self.syscall = ctypes.CDLL(None, use_errno=True).syscall
+        self.syscall.argtypes = (ctypes.c_long, ctypes.c_void_p, ctypes.c_int, ctypes.c_uint,
+                                 ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int)
+        self.timespec = Timespec(0, int(self.WAKE_TIMEOUT * 1e9))
+        self.timeout = ctypes.addressof(self.timespec)
+        if side == SERVER:
+            self.incoming, self.outgoing = to_server, to_client
+        else:
+            self.incoming, self.outgoing = to_client, to_server
+        self.words[W_CLOSED[side]] = 0
+
+    def peer_closed(self) -> bool:
+        return self.words[W_CLOSED[1 - self.side]] != 0
+
+    def futex(self, word, op, value, timeout):
+        # the low half of the 8 byte word, little endian
+        return self.syscall(SYS_FUTEX, self.base + word * 8, op, value, timeout, None, 0)
+
+    def ring(self, waits, bell):
+        # a sleeper reads the bell after saying it waits, so the bell only
+        # needs ringing for one that does
+        words = self.words
+        if words[waits]:
+            words[bell] = (words[bell] + 1) & 0xffffffff
+            self.futex(bell, FUTEX_WAKE, 1, None)
+
+    def wait(self, ready, waits, bell):
+        for _ in range(self.SPIN):
+            if ready():
+                return
+        self.words[waits] = 1
+        try:
+            while True:
+                # a bell rung after this read makes the futex return at once
+                seen = self.words[bell]
+                if ready():
+                    return
+                self.futex(bell, FUTEX_WAIT, seen, self.timeout)
+        finally:
+            self.words[waits] = 0
+
+    def readinto(self, buf) -> int:
+        view = memoryview(buf)
+        incoming = self.incoming
+        while True:
+            count = incoming.get_into(view)
+            if count > 0:
+                self.ring(incoming.writer_waits, incoming.writer_bell)
+                return count
+            if self.peer_closed() and incoming.available() == 0:
+                return 0
+            self.wait(lambda: incoming.available() > 0 or self.peer_closed(),
+                      incoming.reader_waits, incoming.reader_bell)
+
+    def read(self, n=-1):
+        # blocks until n bytes are in, fewer only once the peer is gone
+        incoming = self.incoming
+        data = incoming.take(n)
+        if data is not None:
+            self.ring(incoming.writer_waits, incoming.writer_bell)
+            return data
+        data = bytearray(n)
+        view = memoryview(data)
+        got = 0
+        while got < n:
+            count = self.readinto(view[got:])
+            if count == 0:
+                break
+            got += count
+        if got < n:
+            return bytes(data[:got])
+        return data
+
+    def write(self, data) -> int:
+        outgoing = self.outgoing
+        if not self.peer_closed() and outgoing.give(data):
+            self.ring(outgoing.reader_waits, outgoing.reader_bell)
+            return len(data)
+        view = memoryview(data)
+        done = 0
+        while done < len(view):
+            if self.peer_closed():
+                self.fatal("ShmRing: peer closed.")
+            count = outgoing.put(view[done:])
+            if count > 0:
+                done += count
+                self.ring(outgoing.reader_waits, outgoing.reader_bell)
+            else:
+                self.wait(lambda: outgoing.space() > 0 or self.peer_closed(),
+                          outgoing.writer_waits, outgoing.writer_bell)
+        return done
+
+    def close(self):
+        self.words[W_CLOSED[self.side]] = 1
+        # wake the peer whatever it waits for
+        self.ring(self.outgoing.reader_waits, self.outgoing.reader_bell)
+        self.ring(self.incoming.writer_waits, self.incoming.writer_bell)
+        self.incoming = None
+        self.outgoing = None
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.words = None
+        self.map.close()
+        self.file.close()
+        if self.side == SERVER and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class ShmRingServer(ShmRingEndpoint):
+    # creates the mapping and the doorbells, size bytes per direction
+    def __init__(self, path, size=65536):
+        if size % 64 != 0:
+            self.fatal("ShmRing: size must be a multiple of 64.")
+        super().__init__(path, SERVER, size)
+
+
+class ShmRingClient(ShmRingEndpoint):
+    # attaches to a ring a ShmRingServer has created
+    def __init__(self, path):
+        super().__init__(path, CLIENT)